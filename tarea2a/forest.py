@@ -1,4 +1,8 @@
+import queue
 import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
 import glfw
 from OpenGL.GL import *
@@ -14,13 +18,21 @@ import easy_shaders as es
 import lighting_shaders as ls
 
 import obj_model as ob
+import height_field as hf
+import terrain_lod as trl
+import terrain_displacement as td
 import tree
+import tree_cache as tc
+import tree_lod as tl
+import tree_impostors as ti
 
 HELP_TEXT = """
 SPACE: toggle fill or line mode
 ENTER: toggle axis
 ARROW UP/DOWN: move camera up or down
 ARROW LEFT/RIGHT: move camera left or right
+W/S: zoom in or out
+I/K/J/L: walk forward, back, left or right (world mode)
 """
 
 # A class to store the application control
@@ -34,6 +46,10 @@ class Controller:
         self.left = False
         self.zoomIn = False
         self.zoomOut = False
+        self.forward = False
+        self.backward = False
+        self.moveLeft = False
+        self.moveRight = False
 
 
 # we will use the global controller as communication with the callback function
@@ -54,6 +70,14 @@ def on_key(window, key, scancode, action, mods):
         controller.zoomIn = (action == glfw.PRESS or action == glfw.REPEAT)
     elif key == glfw.KEY_S:
         controller.zoomOut = (action == glfw.PRESS or action == glfw.REPEAT)
+    elif key == glfw.KEY_I:
+        controller.forward = (action == glfw.PRESS or action == glfw.REPEAT)
+    elif key == glfw.KEY_K:
+        controller.backward = (action == glfw.PRESS or action == glfw.REPEAT)
+    elif key == glfw.KEY_J:
+        controller.moveLeft = (action == glfw.PRESS or action == glfw.REPEAT)
+    elif key == glfw.KEY_L:
+        controller.moveRight = (action == glfw.PRESS or action == glfw.REPEAT)
     
     elif key == glfw.KEY_SPACE:
         if action == glfw.PRESS:
@@ -74,7 +98,8 @@ def create_terrain(width, lenght, spu, fz):
     # width - Terrain width
     # lenght - Terrain lenght
     # spu - Squares per unit (model square density)
-    # fz - Height function fz(x,y)->z
+    # fz - Height function fz(x,y)->z, evaluated over arrays of points. If it
+    #      has a gradient(x,y)->(dfdx,dfdy) method it is used for the normals
     assert(spu>0)
     w_n = int(width*spu) +1
     dw = width/(w_n-1)
@@ -82,86 +107,247 @@ def create_terrain(width, lenght, spu, fz):
     l_n = int(lenght*spu) +1
     dl = lenght/(l_n-1)
     l0 = -lenght/2
-    vertices = []
-    normals = []
-    faces = []
-    # Constants for normal aproximation
-    dw2 = dw/2
-    dl2 = dl/2
-
-    for i in range(w_n):
-        w = w0 + i*dw
-        for j in range(l_n):
-            l = l0 + j*dl
-            vertices.append([w, l, fz(w,l)])
-            # Aproximate normal of vertex by fz
-            # using centered difference
-            dfdw = (fz(w+dw2,l) - fz(w-dw2,l))/(dw)
-            dfdl = (fz(w,l+dl2) - fz(w,l-dl2))/(dl)
-            n = np.array([-dfdw,-dfdl,1])
-            n = n/np.linalg.norm(n)
-            normals.append(n.tolist())
-            # Create faces
-            if (i < (w_n-1)) and (j< (l_n-1)):
-                v = l_n*i + j + 1 # vertex index
-                faces.append(
-                    [[v,None,v],[v+l_n,None,v+l_n],[v+l_n+1,None,v+l_n+1]]
-                )
-                faces.append(
-                    [[v+l_n+1,None,v+l_n+1],[v+1,None,v+1],[v,None,v]]
-                )
-    
-    return ob.OBJModel(vertices, normals, faces)
+    # Vertex l_n*i + j + 1 is at w0 + i*dw, l0 + j*dl
+    w, l = np.meshgrid(w0 + np.arange(w_n)*dw, l0 + np.arange(l_n)*dl, indexing='ij')
+    w = w.ravel()
+    l = l.ravel()
+    vertices = np.column_stack((w, l, np.broadcast_to(fz(w,l), w.shape)))
+    if hasattr(fz, "gradient"):
+        dfdw, dfdl = fz.gradient(w,l)
+    else:
+        # Aproximate normal of vertex by fz
+        # using centered difference
+        dw2 = dw/2
+        dl2 = dl/2
+        dfdw = (fz(w+dw2,l) - fz(w-dw2,l))/(dw)
+        dfdl = (fz(w,l+dl2) - fz(w,l-dl2))/(dl)
+    normals = np.column_stack((-np.broadcast_to(dfdw, w.shape),
+                               -np.broadcast_to(dfdl, w.shape), np.ones(len(w))))
+    normals /= np.linalg.norm(normals, axis=1)[:,np.newaxis]
+    # Two faces for every square, v is the vertex index of its first corner
+    i, j = np.meshgrid(np.arange(w_n-1), np.arange(l_n-1), indexing='ij')
+    v = (l_n*i + j + 1).ravel()
+    corners = np.stack((v, v+l_n, v+l_n+1,
+                        v+l_n+1, v+1, v), axis=1).reshape(-1, 3)
+    # Vertices and normals share their index
+    faces = np.stack((corners, corners), axis=2)
+
+    return ob.from_arrays(vertices, normals, faces)
+
+def random_tree_parameters(rec_level, rng):
+    # Draws the parameters of a random tree species
+    # rec_level - Recursion level of the fractal tree
+    # rng - numpy Generator of the species
+    # return - Tuple of height, split_ang, split_n, decr, rec_level, sides_n
+    #          and base_diameter, as in tree.FractalTree3D
+    height = 0.8 + 0.4*rng.random()
+    angle = np.deg2rad(15 + 70*rng.random())
+    split_n = int(rng.integers(1,5))
+    decr = 0.8 + 0.15*rng.random()
+    sides_n = int(rng.integers(1,6))
+    base_diameter = 0.01 + 0.05*rng.random()
+    return (height,angle,split_n,decr,rec_level,sides_n,base_diameter)
+
+def build_tree_model(params, num_vertex, cache=None):
+    # Builds the obj models of a tree, or loads them from the cache
+    # params - Tree parameters, as returned by random_tree_parameters
+    # num_vertex - Number of vertices of the branch cilinder
+    # cache - (optional) TreeMeshCache to load and store the models
+    # return - Tree and leaves OBJ models
+    if cache is not None:
+        key = tc.TreeMeshCache.key(*params, num_vertex)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    branch_model = ob.cilinderOBJ(num_vertex=num_vertex)
+    leaf_model = ob.leafOBJ()
+    tree_model, leaves_model = tree.get_tree_model_memo(*params, branch_model, leaf_model)
+    if cache is not None:
+        cache.put(key, tree_model, leaves_model)
+    return tree_model, leaves_model
+
+def _to_shared(array):
+    # Copies an array into a new shared memory block
+    # array - numpy array
+    # return - Block name, shape and dtype, to be read by _from_shared
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return shm.name, array.shape, array.dtype.str
+
+def _from_shared(name, shape, dtype):
+    # Copies an array out of a shared memory block
+    # name, shape, dtype - Block description, as returned by _to_shared
+    # return - numpy array
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    shm.close()
+    return array
+
+def _free_shared(name):
+    # Frees a shared memory block
+    # name - Block name, as returned by _to_shared
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
 
-def generate_tree_models(num, rec_level):
+def _build_tree_shared(params, num_vertex):
+    # Builds the models of a tree in a worker process
+    # params - Tree parameters, as returned by random_tree_parameters
+    # num_vertex - Number of vertices of the branch cilinder
+    # return - Shared memory blocks of the tree and leaves arrays
+    models = build_tree_model(params, num_vertex)
+    blocks = []
+    try:
+        for model in models:
+            blocks.append([])
+            for array in model.to_arrays():
+                blocks[-1].append(_to_shared(array))
+    except BaseException:
+        for block in sum(blocks, []):
+            _free_shared(block[0])
+        raise
+    return blocks
+
+def generate_tree_models(num, rec_level, cache=None, seed=None, workers=1):
     # Generates a list of fractal tree models in obj format
     # num - Number of models to generate
     # rec_level - Recursion level of the fractal tree models
-    trees = []
-    leaves = []
-    branch_model = ob.cilinderOBJ(num_vertex=7)
-    leaf_model = ob.leafOBJ()
-    for _ in range(num):
-        height = 0.8 + 0.4*np.random.random()
-        angle = np.deg2rad(15 + 70*np.random.random())
-        split_n = np.random.randint(1,5) 
-        decr = 0.8 + 0.15*np.random.random()
-        sides_n = np.random.randint(1,6)
-        base_diameter = 0.01 + 0.05*np.random.random()
-        fractalTree = tree.FractalTree3D(height,angle,split_n,decr,rec_level,sides_n,base_diameter)
-        tree_model, leaves_model = tree.get_tree_model(fractalTree, branch_model, leaf_model)
-        trees.append(tree_model)
-        leaves.append(leaves_model)
+    # cache - (optional) TreeMeshCache to load and store the generated models
+    # seed - (optional) Forest seed, each species gets its own random stream
+    # workers - Number of processes building the models
+    trees, leaves = generate_tree_lods(num, rec_level, 1, cache, seed, workers)
+    return [lods[0] for lods in trees], [lods[0] for lods in leaves]
+
+def generate_tree_lods(num, rec_level, lod_levels, cache=None, seed=None, workers=1):
+    # Generates a list of fractal tree models with several levels of detail
+    # The random streams of the species are spawned from the seed, so the
+    # models do not depend on the number of workers
+    # num - Number of species to generate
+    # rec_level - Recursion level of the full detail models
+    # lod_levels - Number of levels of detail of each species
+    # cache - (optional) TreeMeshCache to load and store the generated models
+    # seed - (optional) Forest seed, each species gets its own random stream
+    # workers - Number of processes building the models
+    # return - Lists of tree and leaves models, indexed by species and level
+    streams = np.random.SeedSequence(seed).spawn(num)
+    species_params = [random_tree_parameters(rec_level, np.random.default_rng(stream))
+                      for stream in streams]
+    models = {}
+    jobs = []
+    for species, params in enumerate(species_params):
+        for level in range(lod_levels):
+            lod_rec_level, num_vertex = tl.lod_parameters(rec_level, 7, level)
+            lod_params = params[:4] + (lod_rec_level,) + params[5:]
+            cached = None
+            if cache is not None:
+                cached = cache.get(tc.TreeMeshCache.key(*lod_params, num_vertex))
+            if cached is not None:
+                models[species, level] = cached
+            else:
+                jobs.append(((species, level), lod_params, num_vertex))
+
+    if workers > 1 and len(jobs) > 1:
+        # Workers share the tracker of this process, so blocks freed here
+        # are not reported as leaked and the ones left are freed at exit
+        resource_tracker.ensure_running()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_build_tree_shared, params, num_vertex)
+                       for _, params, num_vertex in jobs]
+            try:
+                for (index, _, _), future in zip(jobs, futures):
+                    models[index] = tuple(ob.from_arrays(*[_from_shared(*block) for block in model])
+                                          for model in future.result())
+            finally:
+                # Every block is freed, also those of other jobs when one fails
+                for future in futures:
+                    if future.exception() is None:
+                        for model in future.result():
+                            for block in model:
+                                _free_shared(block[0])
+    else:
+        for index, params, num_vertex in jobs:
+            models[index] = build_tree_model(params, num_vertex)
+    if cache is not None:
+        for index, params, num_vertex in jobs:
+            cache.put(tc.TreeMeshCache.key(*params, num_vertex), *models[index])
+
+    trees = [[models[species, level][0] for level in range(lod_levels)] for species in range(num)]
+    leaves = [[models[species, level][1] for level in range(lod_levels)] for species in range(num)]
     return trees, leaves
 
-def sample_uniform_points(width, lenght, num_points, min_dis, pool=10000):
+def sample_uniform_points(width, lenght, num_points, min_dis, rng=None, k=30):
     # Sample points from a uniform distribution in a 2d plane 
-    # with minimum separation between them
+    # with minimum separation between them (Bridson's Poisson disk sampling)
+    # The plane is filled until no point fits, then num_points of them are
+    # chosen at random, so the points cover the whole plane
     # width - 2D plane width
     # lenght - 2D plane lenght
-    # num_points - maximum number of point to sample
-    # pool - number of samples from which points are selected
+    # num_points - maximum number of point to sample, None to keep them all
+    # min_dis - minimum distance between points
+    # rng - (optional) numpy Generator used for the sampling
+    # k - number of candidates tried around a point before discarding it
+    # return - Matrix of (N,2) of the points x,y coordinates
+    rng = np.random.default_rng() if rng is None else rng
     xmin = -width/2
-    xmax = -xmin
     ymin = -lenght/2
-    ymax = -ymin
-    # Generate a pool of points
-    possible_points = np.array((np.random.uniform(xmin,xmax,pool),
-                       np.random.uniform(ymin,ymax,pool) )).transpose()
-    keep_points = possible_points[0].reshape(1,2)
+    # A cell of the background grid holds at most one point
+    cell = min_dis/np.sqrt(2)
+    nx = int(np.ceil(width/cell))
+    ny = int(np.ceil(lenght/cell))
+    # Grid with the index of the point in each cell, padded to check
+    # the 5x5 neighbourhood of a cell without bounds checks
+    grid = np.full((nx+4, ny+4), -1, dtype=np.int64)
+    points = np.empty((nx*ny, 2))
+    active = np.empty(nx*ny, dtype=np.int64)
+    offsets = np.arange(-2, 3)
+
+    def add_point(point, count, n_active):
+        points[count] = point
+        i, j = ((points[count] - (xmin, ymin))/cell).astype(np.int64)
+        grid[i+2, j+2] = count
+        active[n_active] = count
+
+    add_point((xmin + width*rng.random(), ymin + lenght*rng.random()), 0, 0)
     count = 1
-    for i in range(1,len(possible_points)):
-        point = possible_points[i]
-        distances = np.sqrt(
-            (keep_points[:,0]-point[0])**2 + (keep_points[:,1]-point[1])**2
-        )
-        # Pick point if it's separated from the rest
-        if min(distances) >= min_dis:
-            keep_points = np.concatenate((keep_points,point.reshape(1,2)))
-            count+=1
-            if count == num_points:
-                return keep_points
-    return keep_points
+    n_active = 1
+    while n_active > 0:
+        a = rng.integers(n_active)
+        center = points[active[a]]
+        # Candidates uniformly distributed in the ring [min_dis, 2*min_dis]
+        radius = min_dis*np.sqrt(1 + 3*rng.random(k))
+        angle = 2*np.pi*rng.random(k)
+        candidates = center + radius[:,np.newaxis]*np.column_stack((np.cos(angle), np.sin(angle)))
+        inside = ((candidates[:,0] >= xmin) & (candidates[:,0] < xmin + width) &
+                  (candidates[:,1] >= ymin) & (candidates[:,1] < ymin + lenght))
+        candidates = candidates[inside]
+        cells = ((candidates - (xmin, ymin))/cell).astype(np.int64) + 2
+        # Points near each candidate, (K,5,5) indices where -1 is an empty cell
+        near = grid[cells[:,0,np.newaxis,np.newaxis] + offsets[:,np.newaxis],
+                    cells[:,1,np.newaxis,np.newaxis] + offsets]
+        distances = np.linalg.norm(points[np.maximum(near, 0)] - candidates[:,np.newaxis,np.newaxis], axis=3)
+        valid = np.all((near < 0) | (distances >= min_dis), axis=(1, 2))
+        if np.any(valid):
+            add_point(candidates[np.argmax(valid)], count, n_active)
+            count += 1
+            n_active += 1
+        else:
+            # Remove the point from the active list
+            n_active -= 1
+            active[a] = active[n_active]
+
+    if num_points is not None and num_points < count:
+        return points[rng.choice(count, num_points, replace=False)]
+    return points[rng.permutation(count)]
+
+def tree_heights(locations, fz):
+    # Gets the height of the tree bases, all the trees are evaluated at once
+    # locations - Matrix of (N,2) of the trees x,y coordinates
+    # fz - Terrain height function fz(x,y)->z, usually a HeightField
+    # return - (N,) array of heights
+    locations = np.asarray(locations).reshape(-1, 2)
+    heights = np.broadcast_to(fz(locations[:,0], locations[:,1]), len(locations))
+    return heights - 0.03 # Lower to avoid floating trees
 
 def populate_forest(locations, fz, treeGPUModels, scale=0.5):
     # Populates a forest terrain with tree models generating 
@@ -171,16 +357,90 @@ def populate_forest(locations, fz, treeGPUModels, scale=0.5):
     # treeGPUModels - List of tree models
     scale_tr = tr.uniformScale(scale)
     forest_trees = sg.SceneGraphNode("forest_trees")
+    heights = tree_heights(locations, fz)
     for i in range(len(locations)):
         tree_node = sg.SceneGraphNode("tree")
         x, y = locations[i]
-        z = fz(x,y) - 0.03 # Lower to avoid floating trees
+        z = heights[i]
         tree_node.transform = tr.matmul([tr.translate(x, y, z),scale_tr])
         model = i%len(treeGPUModels)
         tree_node.childs = [treeGPUModels[model]]
         forest_trees.childs.append(tree_node)
     return forest_trees
 
+def lod_triangles(trees_models, leaves_models, impostors=False):
+    # Counts the triangles of the levels of detail of each species
+    # trees_models - List of OBJ trees models, indexed by species and level
+    # leaves_models - List of OBJ leaves models, indexed by species and level
+    # impostors - Add a last level where trees are drawn as impostor quads
+    # return - List of triangles, indexed by species and level
+    triangles = [[len(t.to_arrays()[2]) + len(l.to_arrays()[2]) for t, l in zip(t_lods, l_lods)]
+                 for t_lods, l_lods in zip(trees_models, leaves_models)]
+    if impostors:
+        triangles = [species_triangles + [2] for species_triangles in triangles]
+    return triangles
+
+def create_lod_selector(locations, fz, trees_models, leaves_models, distances,
+                        max_triangles=None, impostors=False, scale=0.5):
+    # Creates the level of detail selector of the trees of populate_forest
+    # locations - Matrix of (N,2) of the trees x,y coordinates
+    # fz - Terrain height function fz(x,y)->z
+    # trees_models - List of OBJ trees models, indexed by species and level
+    # leaves_models - List of OBJ leaves models, indexed by species and level
+    # distances - Camera distances where each level ends
+    # max_triangles - (optional) Maximum number of triangles to draw
+    # impostors - Add a last level where trees are drawn as impostor quads
+    # scale - Scale factor for the trees
+    # return - TreeLODSelector
+    positions = np.column_stack((np.asarray(locations).reshape(-1, 2), tree_heights(locations, fz)))
+    # Use the middle of the tree to measure the distance
+    positions[:,2] += 0.5*scale
+    species = np.arange(len(locations)) % len(trees_models)
+    triangles = lod_triangles(trees_models, leaves_models, impostors)
+    return tl.TreeLODSelector(positions, species, triangles, distances,
+                              max_triangles=max_triangles)
+
+def update_forest_lod(forest_trees, tree_nodes, selector, treeGPULods, view_pos):
+    # Updates the models drawn by the trees of populate_forest
+    # forest_trees - Scene graph node returned by populate_forest
+    # tree_nodes - List with the node of every tree, as the childs first
+    #              returned by populate_forest
+    # selector - TreeLODSelector of the trees
+    # treeGPULods - List of tree models, indexed by species and level
+    # view_pos - Camera position
+    # return - Indices of the trees whose level changed
+    changed = selector.update(view_pos)
+    if len(changed) == 0:
+        return changed
+    # Levels past the models are drawn as impostors, their nodes are left out
+    lods_n = np.array([len(lods) for lods in treeGPULods])
+    drawn = selector.levels < lods_n[selector.species]
+    for i in changed:
+        if drawn[i]:
+            tree_nodes[i].childs = [treeGPULods[selector.species[i]][selector.levels[i]]]
+    forest_trees.childs = [tree_nodes[i] for i in np.flatnonzero(drawn)]
+    return changed
+
+def set_phong_lights(pipeline):
+    # Sets the lights and materials of the forest
+    # pipeline - SimplePhongShaderProgram in use
+    # White light in all components: ambient, diffuse and specular.
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La"), 1.0, 1.0, 1.0)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld"), 1.0, 1.0, 1.0)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls"), 1.0, 1.0, 1.0)
+
+    # Object is barely visible at only ambient. Diffuse behavior is slightly red. Sparkles are white
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka"), 0.3, 0.3, 0.3)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd"), 0.9, 0.5, 0.5)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks"), 0.05, 0.05, 0.05)
+
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition"), -5, -5, 5)
+    glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess"), 100)
+    
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation"), 0.0001)
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation"), 0.03)
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation"), 0.01)
+
 def generate_forest_trees_obj(locations, fz, trees_models, leaves_models, scale=0.5):
     # Generates an obj model with all the trees merged
     # locations - Matrix of (N,2) of the trees x,y coordinates
@@ -189,20 +449,23 @@ def generate_forest_trees_obj(locations, fz, trees_models, leaves_models, scale=
     # leaves_models - List of OBJ leaves models
     # scales - Scale factor for the trees
     scale_tr = tr.uniformScale(scale)
-    forest_trees = []
+    transforms = []
+    heights = tree_heights(locations, fz)
     for i in range(len(locations)):
         x, y = locations[i]
-        z = fz(x,y) - 0.03 # Lower to avoid floating trees
-        M = tr.matmul([tr.translate(x, y, z),scale_tr])
-        model = i%len(trees_models)
-        moved_tree = trees_models[model].transform(M)
-        moved_leaves = leaves_models[model].transform(M)
-        moved_tree.join(moved_leaves)
-        forest_trees.append(moved_tree)
-    merged_trees_model = forest_trees[0]
-    for i in range(1,len(forest_trees)):
-        merged_trees_model.join(forest_trees[i])
-    return merged_trees_model
+        z = heights[i]
+        transforms.append(tr.matmul([tr.translate(x, y, z),scale_tr]))
+    transforms = np.array(transforms)
+    # Every tree of a model is transformed at once
+    forest_trees = []
+    for model in range(len(trees_models)):
+        model_transforms = transforms[model::len(trees_models)]
+        if len(model_transforms) == 0:
+            continue
+        tree_arrays = ob.concatenate_arrays([trees_models[model].to_arrays(),
+                                             leaves_models[model].to_arrays()])
+        forest_trees.append(ob.transform_arrays(*tree_arrays, model_transforms))
+    return ob.from_arrays(*ob.concatenate_arrays(forest_trees))
 
 # A class to create a gaussian function
 class Gaussian:
@@ -227,14 +490,127 @@ class Gaussian:
         my = ((y-self.y0)/self.stdy)**2
         return self.sign*self.const*np.exp(-0.5*(mx+my))
 
-def generate_random_terrain_fun(gauss_num, spikyness):
+    def gradient(self,x,y):
+        # x - x position
+        # y - y position
+        # return - Partial derivatives of the gaussian at x,y
+        value = self(x,y)
+        return (-value*(x-self.x0)/self.stdx**2,
+                -value*(y-self.y0)/self.stdy**2)
+
+# A class to create a sum of gaussian functions
+class GaussianSum:
+    def __init__(self, gaussians, cutoff=None, max_pairs=2**22):
+        # Each gaussian is dropped beyond cutoff standard deviations of its
+        # center and stored in the cells of a uniform grid that its support
+        # touches, so a point only sums the gaussians of its cell
+        # gaussians - List of Gaussian
+        # cutoff - (optional) Number of standard deviations of the support
+        #          of the gaussians, without it every gaussian is used
+        # max_pairs - Maximum number of point, gaussian pairs evaluated at once
+        self.gaussians = gaussians
+        self.cutoff = cutoff
+        self.max_pairs = max_pairs
+        self.params = np.array([[g.x0, g.y0, g.stdx, g.stdy, g.sign*g.const]
+                                for g in gaussians]).reshape(-1, 5)
+        x0, y0, stdx, stdy, _ = self.params.T
+        if cutoff is None or len(gaussians) == 0:
+            # A single cell with all the gaussians
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.shape = (1, 1)
+            self.cell_start = np.array([0, len(gaussians)])
+            self.cell_gaussians = np.arange(len(gaussians))
+            return
+        # Support rectangle of each gaussian
+        low = np.column_stack((x0 - cutoff*stdx, y0 - cutoff*stdy))
+        high = np.column_stack((x0 + cutoff*stdx, y0 + cutoff*stdy))
+        self.origin = low.min(axis=0)
+        # Cells of half the usual support, with at most 1024 cells by side
+        extent = np.max(high.max(axis=0) - self.origin)
+        self.cell_size = max(0.5*cutoff*np.median(np.maximum(stdx, stdy)), extent/1024)
+        self.shape = tuple(np.floor((high.max(axis=0) - self.origin)/self.cell_size).astype(np.int64) + 1)
+        first = np.floor((low - self.origin)/self.cell_size).astype(np.int64)
+        last = np.floor((high - self.origin)/self.cell_size).astype(np.int64)
+        # Every (gaussian, cell) pair of the supports
+        counts = np.prod(last - first + 1, axis=1)
+        gauss_ids = np.repeat(np.arange(len(gaussians)), counts)
+        local = np.arange(len(gauss_ids)) - np.repeat(np.cumsum(counts) - counts, counts)
+        span_y = (last - first + 1)[gauss_ids, 1]
+        cells = ((first[gauss_ids, 0] + local // span_y)*self.shape[1] +
+                 first[gauss_ids, 1] + local % span_y)
+        # Gaussians sorted by cell, cell c has cell_gaussians[cell_start[c]:cell_start[c+1]]
+        order = np.argsort(cells, kind='stable')
+        self.cell_gaussians = gauss_ids[order]
+        self.cell_start = np.concatenate(
+            [[0], np.cumsum(np.bincount(cells, minlength=self.shape[0]*self.shape[1]))])
+
+    def _evaluate(self, x, y):
+        # Method to sum the local gaussians at an array of points
+        # x, y - Flat arrays of positions
+        # return - Height and partial derivatives at the points
+        z = np.zeros(len(x))
+        dfdx = np.zeros(len(x))
+        dfdy = np.zeros(len(x))
+        cell_xy = np.floor((np.column_stack((x, y)) - self.origin)/self.cell_size).astype(np.int64)
+        cell_xy = np.clip(cell_xy, 0, np.array(self.shape) - 1)
+        cells = cell_xy[:,0]*self.shape[1] + cell_xy[:,1]
+        counts = self.cell_start[cells+1] - self.cell_start[cells]
+        # Points are evaluated in chunks of at most max_pairs pairs
+        ends = np.cumsum(counts)
+        start = 0
+        while start < len(x):
+            limit = (ends[start-1] if start > 0 else 0) + self.max_pairs
+            stop = max(np.searchsorted(ends, limit, side='right'), start + 1)
+            chunk_counts = counts[start:stop]
+            points = np.repeat(np.arange(start, stop), chunk_counts)
+            local = np.arange(len(points)) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            gauss_ids = self.cell_gaussians[self.cell_start[cells[points]] + local]
+            x0, y0, stdx, stdy, amplitude = self.params[gauss_ids].T
+            ux = (x[points] - x0)/stdx
+            uy = (y[points] - y0)/stdy
+            value = amplitude*np.exp(-0.5*(ux**2 + uy**2))
+            if self.cutoff is not None:
+                value[(np.abs(ux) > self.cutoff) | (np.abs(uy) > self.cutoff)] = 0
+            n = stop - start
+            z[start:stop] = np.bincount(points - start, value, minlength=n)
+            dfdx[start:stop] = np.bincount(points - start, -value*ux/stdx, minlength=n)
+            dfdy[start:stop] = np.bincount(points - start, -value*uy/stdy, minlength=n)
+            start = stop
+        return z, dfdx, dfdy
+
+    def __call__(self,x,y):
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - Terrain height at x,y
+        return self.height_and_gradient(x,y)[0]
+
+    def gradient(self,x,y):
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - Partial derivatives of the terrain at x,y
+        return self.height_and_gradient(x,y)[1:]
+
+    def height_and_gradient(self,x,y):
+        # Evaluates every local gaussian once for the height and its derivatives
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - Terrain height and partial derivatives at x,y
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        values = self._evaluate(x.ravel(), y.ravel())
+        if x.ndim == 0:
+            return tuple(v[0] for v in values)
+        return tuple(v.reshape(x.shape) for v in values)
+
+def generate_random_terrain_fun(gauss_num, spikyness, cutoff=4.0):
     # Creaete a random terrain height function by  the sum
     # of gaussians
     # gauss_num - Number of gaussians to use
     # spikyness - Number to determine how flat or spiky is the generated terrain
-    # return - Lambda function f(x,y) -> z
+    # cutoff - (optional) Number of standard deviations where gaussians are dropped
+    # return - GaussianSum function f(x,y) -> z
     if spikyness == 0: # Create flat terrain
-        return lambda x,y: 0.0
+        return GaussianSum([])
     gaussians = []
     
     for _ in range(gauss_num):
@@ -244,7 +620,231 @@ def generate_random_terrain_fun(gauss_num, spikyness):
         stdy = (0.5 + 0.5*np.random.random())/spikyness
         sign = np.random.randint(0,2)
         gaussians.append(Gaussian(x0,y0,stdx,stdy,sign))
-    return lambda x,y: sum([g(x,y) for g in gaussians])
+    return GaussianSum(gaussians, cutoff)
+
+def _chunk_rng(seed, key, stream):
+    # Creates the random generator of a chunk, it only depends on the seed
+    # seed - World seed
+    # key - (i,j) chunk coordinates
+    # stream - Index of the stream: 0 for the terrain, 1 for the trees
+    return np.random.default_rng(np.random.SeedSequence(
+        seed, spawn_key=(key[0] + 2**31, key[1] + 2**31, stream)))
+
+def chunk_gaussians(seed, key, chunk_size, gauss_num, spikyness):
+    # Draws the gaussians centered in a chunk
+    # seed - World seed
+    # key - (i,j) chunk coordinates, the chunk is centered at (i,j)*chunk_size
+    # chunk_size - Side of the chunks
+    # gauss_num - Number of gaussians in each chunk
+    # spikyness - Number to determine how flat or spiky is the terrain
+    # return - (gauss_num,5) array of x0, y0, stdx, stdy and sign
+    rng = _chunk_rng(seed, key, 0)
+    params = rng.random((gauss_num, 5))
+    params[:,0] = (key[0] - 0.5 + params[:,0])*chunk_size
+    params[:,1] = (key[1] - 0.5 + params[:,1])*chunk_size
+    params[:,2:4] = (0.5 + 0.5*params[:,2:4])/spikyness
+    params[:,4] = params[:,4] < 0.5
+    return params
+
+# A class to generate an unlimited forest in square chunks around the camera
+class ChunkWorld(object):
+    def __init__(self, seed, gauss_num, spikyness, tree_den, treeGPULods,
+                 triangles, distances, bounds, chunk_size=4, spu=7, view_chunks=2,
+                 max_bytes=64*2**20, workers=2, max_uploads=2, max_pending=4,
+                 cutoff=4.0, scale=0.5):
+        # Chunks are generated in worker threads from their own seed, so a
+        # chunk is the same every time it is generated. Chunks are kept in
+        # least recently used order and freed while over the memory budget.
+        # At most max_pending chunks are generated or waiting for the upload,
+        # chunks that leave the view before their upload are dropped.
+        # Each tree gets its level of detail as in the single forest, trees
+        # past the last distance are drawn as impostors
+        # seed - World seed
+        # gauss_num - Number of terrain gaussians in each chunk
+        # spikyness - Number to determine how flat or spiky is the terrain
+        # tree_den - Density of trees ]0,1]
+        # treeGPULods - List of tree models, indexed by species and level
+        # triangles - Triangles of each species and level, with the impostor level
+        # distances - Camera distances where each level ends
+        # bounds - (S,2) array with the radius and height of each species
+        # chunk_size - Side of the chunks
+        # spu - Terrain squares per unit
+        # view_chunks - Number of chunks drawn around the camera chunk
+        # max_bytes - CPU and GPU memory budget for the chunks
+        # workers - Number of threads generating chunks
+        # max_uploads - Maximum number of chunks uploaded in a frame
+        # max_pending - Maximum number of chunks in generation or waiting for the upload
+        # cutoff - Number of standard deviations where gaussians are dropped
+        # scale - Scale factor for the trees
+        self.seed = seed
+        self.gauss_num = gauss_num if spikyness > 0 else 0
+        self.spikyness = spikyness
+        self.treeGPULods = treeGPULods
+        self.triangles = triangles
+        self.distances = distances
+        self.bounds = bounds
+        self.impostor_level = len(distances)
+        self.gpuQuad = es.toGPUShape(ti.createImpostorQuad())
+        self.chunk_size = chunk_size
+        self.spu = spu
+        self.view_chunks = view_chunks
+        self.max_bytes = max_bytes
+        self.max_uploads = max_uploads
+        self.max_pending = max_pending
+        self.cutoff = cutoff
+        self.scale = scale
+        self.tree_rad = 0.2
+        self.num_trees = int(chunk_size**2/(np.pi*self.tree_rad**2)*tree_den)
+        # Chunks whose gaussians can reach a chunk
+        if self.gauss_num > 0:
+            self.reach = int(np.ceil(cutoff/spikyness/chunk_size))
+        else:
+            self.reach = 0
+        self.used_bytes = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ready = queue.Queue(maxsize=max_pending)
+        # Chunks in generation or in the ready queue, key -> future
+        self.pending = {}
+        # Chunks still worth generating, read by the worker threads
+        self.wanted = frozenset()
+        # Least recently used chunks first, key -> dict of chunk data
+        self.chunks = OrderedDict()
+        self.visible = []
+        self.node = sg.SceneGraphNode("world")
+
+    def generate(self, key):
+        # Method to build the terrain and trees of a chunk, runs in a worker thread
+        # The chunk is in local coordinates, centered at the origin
+        # key - (i,j) chunk coordinates
+        # return - Dict with the chunk height field, terrain shape and trees
+        center = np.array(key)*self.chunk_size
+        params = [chunk_gaussians(self.seed, (key[0]+a, key[1]+b), self.chunk_size,
+                                  self.gauss_num, self.spikyness)
+                  for a in range(-self.reach, self.reach+1)
+                  for b in range(-self.reach, self.reach+1)]
+        gaussians = [Gaussian(x0 - center[0], y0 - center[1], stdx, stdy, sign)
+                     for x0, y0, stdx, stdy, sign in np.concatenate(params)]
+        fz = hf.HeightField(GaussianSum(gaussians, self.cutoff),
+                            self.chunk_size, self.chunk_size, self.spu)
+        terrain = create_terrain(self.chunk_size, self.chunk_size, self.spu, fz)
+        rng = _chunk_rng(self.seed, key, 1)
+        locations = sample_uniform_points(self.chunk_size, self.chunk_size,
+                                          self.num_trees, self.tree_rad, rng=rng)
+        species = rng.integers(len(self.treeGPULods), size=len(locations))
+        positions = np.column_stack((locations, tree_heights(locations, fz)))
+        return {"height_field": fz, "shape": terrain.to_shape((0,0.5,0.3)),
+                "positions": positions, "species": species}
+
+    def _generate(self, key):
+        # Method to generate a chunk and queue it for the upload, chunks
+        # that left the view are queued without data
+        # key - (i,j) chunk coordinates
+        chunk = self.generate(key) if key in self.wanted else None
+        self.ready.put((key, chunk))
+
+    def chunk_key(self, x, y):
+        # x, y - World position
+        # return - (i,j) coordinates of the chunk of the position
+        return (int(np.floor(x/self.chunk_size + 0.5)), int(np.floor(y/self.chunk_size + 0.5)))
+
+    def _upload(self, key, chunk):
+        # Method to create the GPU models and scene node of a chunk
+        # Must be called from the thread that owns the OpenGL context
+        shape = chunk.pop("shape")
+        terrain_node = sg.SceneGraphNode("terrain_node")
+        terrain_node.childs = [es.toGPUShape(shape)]
+        # Trees start without a model, the selector chooses it and
+        # fills the trees node in the first update
+        trees_node = sg.SceneGraphNode("trees")
+        scale_tr = tr.uniformScale(self.scale)
+        chunk["tree_nodes"] = []
+        for x, y, z in chunk["positions"]:
+            tree_node = sg.SceneGraphNode("tree")
+            tree_node.transform = tr.matmul([tr.translate(x, y, z), scale_tr])
+            chunk["tree_nodes"].append(tree_node)
+        node = sg.SceneGraphNode(f"chunk_{key[0]}_{key[1]}")
+        node.transform = tr.translate(key[0]*self.chunk_size, key[1]*self.chunk_size, 0)
+        node.childs = [terrain_node, trees_node]
+        chunk["node"] = node
+        # The selector and the impostors work in world coordinates
+        world_positions = chunk["positions"] + [key[0]*self.chunk_size, key[1]*self.chunk_size, 0]
+        # Use the middle of the tree to measure the distance
+        chunk["selector"] = tl.TreeLODSelector(world_positions + [0, 0, 0.5*self.scale],
+                                               chunk["species"], self.triangles, self.distances)
+        chunk["impostors"] = ti.ForestImpostors(world_positions, chunk["species"], self.bounds,
+                                                self.scale, self.gpuQuad)
+        chunk["gpu_bytes"] = ((len(shape.vertices) + len(shape.indices))*es.SIZE_IN_BYTES +
+                              chunk["impostors"].instances.nbytes)
+        chunk["cpu_bytes"] = (chunk["height_field"].samples.nbytes +
+                              chunk["positions"].nbytes + chunk["species"].nbytes)
+        self.used_bytes += chunk["gpu_bytes"] + chunk["cpu_bytes"]
+        self.chunks[key] = chunk
+
+    def update(self, center, view_pos):
+        # Method to generate, upload and free chunks as the camera moves
+        # Must be called from the thread that owns the OpenGL context
+        # center - Position looked by the camera
+        # view_pos - Camera position
+        ci, cj = self.chunk_key(center[0], center[1])
+        n = self.view_chunks
+        visible = [(ci+a, cj+b) for a in range(-n, n+1) for b in range(-n, n+1)]
+        # Closest chunks are generated first
+        visible.sort(key=lambda k: (k[0]-ci)**2 + (k[1]-cj)**2)
+        self.wanted = frozenset(visible)
+        # Chunks that left the view are cancelled if their generation did not start
+        for key, future in list(self.pending.items()):
+            if key not in self.wanted and future.cancel():
+                del self.pending[key]
+        for key in visible:
+            if len(self.pending) >= self.max_pending:
+                break
+            if key not in self.chunks and key not in self.pending:
+                self.pending[key] = self.executor.submit(self._generate, key)
+        uploads = 0
+        while uploads < self.max_uploads:
+            try:
+                key, chunk = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            del self.pending[key]
+            if chunk is not None and key in self.wanted:
+                self._upload(key, chunk)
+                uploads += 1
+        # Trees change level with hysteresis, far trees become impostors
+        for key in visible:
+            if key not in self.chunks:
+                continue
+            self.chunks.move_to_end(key)
+            chunk = self.chunks[key]
+            if len(update_forest_lod(chunk["node"].childs[1], chunk["tree_nodes"],
+                                     chunk["selector"], self.treeGPULods, view_pos)) > 0:
+                chunk["impostors"].update(chunk["selector"].levels == self.impostor_level)
+        self.visible = [key for key in visible if key in self.chunks]
+        self.node.childs = [self.chunks[key]["node"] for key in self.visible]
+        # Free hidden chunks while over the memory budget
+        visible = set(visible)
+        for key in list(self.chunks.keys()):
+            if self.used_bytes <= self.max_bytes:
+                break
+            if key not in visible:
+                self.free(key)
+
+    def free(self, key):
+        # Method to free the GPU buffers and the data of a chunk
+        # key - (i,j) chunk coordinates
+        chunk = self.chunks.pop(key)
+        gpuShape = chunk["node"].childs[0].childs[0]
+        glDeleteBuffers(2, [gpuShape.vbo, gpuShape.ebo])
+        glDeleteVertexArrays(1, [gpuShape.vao])
+        chunk["impostors"].free()
+        self.used_bytes -= chunk["gpu_bytes"] + chunk["cpu_bytes"]
+
+    def draw_impostors(self, pipeline, atlas):
+        # Method to draw the impostor trees of the visible chunks
+        # pipeline - ImpostorShaderProgram in use
+        # atlas - ImpostorAtlas with the rendered species
+        for key in self.visible:
+            self.chunks[key]["impostors"].draw(pipeline, atlas)
 
 if __name__ == "__main__":
     # Parse arguments
@@ -261,9 +861,31 @@ if __name__ == "__main__":
                     help='(float) Determines how spiky or flat is the generated terrain [0, inf[')
     parser.add_argument('seed', metavar='Seed', type=int,
                     help='(int) Seed for random number generators')
+    parser.add_argument('--cache', metavar='Cache_dir', type=str, default=None,
+                    help='(string) Folder to keep the generated tree models between runs')
+    parser.add_argument('--cache_mb', metavar='Cache_size', type=float, default=256,
+                    help='(float) Maximum size of the tree models folder in MB')
+    parser.add_argument('--workers', metavar='Workers', type=int, default=1,
+                    help='(int) Number of processes generating the tree species')
+    parser.add_argument('--max_triangles', metavar='Triangles', type=int, default=None,
+                    help='(int) Maximum number of tree triangles drawn in a frame')
+    parser.add_argument('--world', action='store_true',
+                    help='Generate an unlimited forest in chunks around the camera, no model is saved')
+    parser.add_argument('--world_mb', metavar='World_size', type=float, default=64,
+                    help='(float) Memory budget of the world chunks in MB')
+    parser.add_argument('--terrain_spu', metavar='Terrain_detail', type=float, default=7,
+                    help='(float) Terrain squares per unit of lenght')
+    parser.add_argument('--terrain_triangles', metavar='Terrain_triangles', type=int, default=None,
+                    help='(int) Draw the terrain in tiles with a level of detail, keeping this number of triangles')
+    parser.add_argument('--terrain_gpu', action='store_true',
+                    help='Keep the terrain heights in a texture and displace a flat grid in the vertex shader')
     args = parser.parse_args()
     assert(0 < args.tree_den <= 1)
     assert(0 < args.gauss_num)
+    assert(not (args.terrain_gpu and args.terrain_triangles is not None))
+    # The world has its own terrain chunks and trees level of detail
+    assert(not (args.world and (args.terrain_gpu or args.terrain_triangles is not None or
+                                args.max_triangles is not None)))
 
     # Set seed for random number generator
     np.random.seed(args.seed) 
@@ -291,6 +913,8 @@ if __name__ == "__main__":
     # Assembling the shader program (pipeline) with both shaders
     mvpPipeline = es.SimpleModelViewProjectionShaderProgram()
     phongPipeline = ls.SimplePhongShaderProgram()
+    impostorPipeline = ti.ImpostorShaderProgram()
+    displacementPipeline = td.DisplacementPhongShaderProgram()
 
     # Setting up the clear screen color
     glClearColor(0.85, 0.85, 0.85, 1.0)
@@ -309,39 +933,93 @@ if __name__ == "__main__":
     camera_r = 3
     ltime = 0
 
+    camera_center = np.zeros(3)
+
     # FOREST GENERATION
     # Terrain dimension
     f_width = 4
     f_lenght = 4
-    # Create forest terrain
-    fz = generate_random_terrain_fun(args.gauss_num, args.spikyness)
-    terrain = create_terrain(width=f_width, lenght=f_lenght, spu=7, fz=fz)
-    terrain_node = sg.SceneGraphNode("terrain_node")
-    terrain_node.childs = [es.toGPUShape(terrain.to_shape((0,0.5,0.3)))]
 
     # Create trees
-    trees, leaves = generate_tree_models(num=args.species_num, rec_level=3)
+    cache = None
+    if args.cache is not None:
+        cache = tc.TreeMeshCache(args.cache, max_bytes=int(args.cache_mb*2**20))
+    # Trees past the last distance are drawn as impostors
+    lod_distances = (1.0, 2.0, 3.0)
+    trees_lods, leaves_lods = generate_tree_lods(num=args.species_num, rec_level=3,
+                                    lod_levels=len(lod_distances), cache=cache,
+                                    seed=args.seed, workers=args.workers)
     treesGPU = []
-    for i in range(len(trees)):
-        treesGPU.append(
-            tree.get_tree_model_sg(tree_obj=trees[i], leaves_obj=leaves[i],
+    for i in range(len(trees_lods)):
+        treesGPU.append([
+            tree.get_tree_model_sg(tree_obj=trees_lods[i][level], leaves_obj=leaves_lods[i][level],
                                     tree_color=(0.59,0.29,0.00), leaves_color=(0,0.7,0))
-        )
-    area = f_width*f_lenght
-    tree_rad = 0.2
-    tree_area = np.pi*(tree_rad**2)
-    num_trees = int((area/tree_area)*args.tree_den)
-    locations = sample_uniform_points(f_width,f_lenght,num_trees, tree_rad)
-    trees_node = populate_forest(locations, fz, treesGPU)
-
-    # Assemble forest
-    forest = sg.SceneGraphNode("forest")
-    forest.childs = [terrain_node, trees_node]
-
-    # Save complete forest model
-    forest_merged_trees = generate_forest_trees_obj(locations, fz, trees, leaves)
-    terrain.join(forest_merged_trees)
-    terrain.to_file(args.filename)
+            for level in range(len(trees_lods[i]))
+        ])
+    # Render the species impostors once
+    bounds = ti.model_bounds([lods[0] for lods in trees_lods], [lods[0] for lods in leaves_lods])
+    atlas = ti.ImpostorAtlas(bounds)
+    glUseProgram(phongPipeline.shaderProgram)
+    set_phong_lights(phongPipeline)
+    atlas.render([lods[0] for lods in treesGPU], phongPipeline)
+    glClearColor(0.85, 0.85, 0.85, 1.0)
+    impostor_level = len(lod_distances)
+
+    world = None
+    terrain_lod = None
+    terrain_heights = None
+    if args.world:
+        # Chunks of the size of the forest replace the single forest
+        world = ChunkWorld(args.seed, args.gauss_num, args.spikyness, args.tree_den, treesGPU,
+                           lod_triangles(trees_lods, leaves_lods, impostors=True),
+                           lod_distances, bounds, chunk_size=f_width, spu=args.terrain_spu,
+                           max_bytes=int(args.world_mb*2**20))
+        forest = world.node
+    else:
+        # Create forest terrain
+        terrain_fun = generate_random_terrain_fun(args.gauss_num, args.spikyness)
+        # The terrain function is sampled once, the mesh and the trees use the samples
+        fz = hf.HeightField(terrain_fun, f_width, f_lenght, spu=args.terrain_spu)
+        terrain = create_terrain(width=f_width, lenght=f_lenght, spu=args.terrain_spu, fz=fz)
+        terrain_node = sg.SceneGraphNode("terrain_node")
+        if args.terrain_gpu:
+            # Only the heights go to the GPU, one float per sample
+            terrain_heights = td.HeightTexture(fz.samples[...,0], f_width, f_lenght)
+            gpuTerrainGrid = es.toGPUShape(td.createGridMesh(fz.w_n, fz.l_n))
+        elif args.terrain_triangles is not None:
+            # Tiles of 16 squares keep the detail of the height field at the finest level
+            terrain_lod = trl.TerrainLOD(fz, f_width, f_lenght, tile_size=16,
+                                         tiles_per_unit=args.terrain_spu/16,
+                                         max_triangles=args.terrain_triangles)
+        else:
+            terrain_node.childs = [es.toGPUShape(terrain.to_shape((0,0.5,0.3)))]
+
+        area = f_width*f_lenght
+        tree_rad = 0.2
+        tree_area = np.pi*(tree_rad**2)
+        num_trees = int((area/tree_area)*args.tree_den)
+        # Tree placement has its own random stream of the forest seed
+        locations = sample_uniform_points(f_width,f_lenght,num_trees, tree_rad,
+                                          rng=np.random.default_rng([args.seed, 1]))
+        # Trees start with the coarsest model, the level is chosen every frame
+        trees_node = populate_forest(locations, fz, [lods[-1] for lods in treesGPU])
+        tree_nodes = list(trees_node.childs)
+        lod_selector = create_lod_selector(locations, fz, trees_lods, leaves_lods,
+                                            lod_distances, max_triangles=args.max_triangles,
+                                            impostors=True)
+        positions = np.column_stack((locations, tree_heights(locations, fz)))
+        impostors = ti.ForestImpostors(positions, lod_selector.species, bounds)
+
+        # Assemble forest
+        forest = sg.SceneGraphNode("forest")
+        forest.childs = [terrain_node, trees_node]
+
+        # Save complete forest model, with the full detail trees
+        trees = [lods[0] for lods in trees_lods]
+        leaves = [lods[0] for lods in leaves_lods]
+        forest_merged_trees = generate_forest_trees_obj(locations, fz, trees, leaves)
+        terrain = ob.concatenate([terrain, forest_merged_trees])
+        terrain.to_file(args.filename)
 
     while not glfw.window_should_close(window):
         # Using GLFW to check for input events
@@ -354,16 +1032,29 @@ if __name__ == "__main__":
         camera_phi = np.clip(camera_phi, 0+0.00001, np.pi/2) # view matrix is NaN when phi=0
         camera_r += 2.0*dt*(controller.zoomOut - controller.zoomIn)
         camera_r = np.clip(camera_r, 0.7, 4)
+        # Walk in the direction the camera looks
+        forward = -np.array([np.sin(camera_theta), np.cos(camera_theta), 0])
+        side = np.array([-forward[1], forward[0], 0])
+        if world is not None:
+            camera_center += 2.0*dt*((controller.forward - controller.backward)*forward +
+                                     (controller.moveLeft - controller.moveRight)*side)
 
         cam_x = camera_r * np.sin(camera_phi) * np.sin(camera_theta)
         cam_y = camera_r * np.sin(camera_phi) * np.cos(camera_theta)
         cam_z = camera_r * np.cos(camera_phi)
 
-        viewPos = np.array([cam_x,cam_y,cam_z])
+        viewPos = camera_center + np.array([cam_x,cam_y,cam_z])
+        if world is not None:
+            world.update(camera_center, viewPos)
+        else:
+            if len(update_forest_lod(trees_node, tree_nodes, lod_selector, treesGPU, viewPos)) > 0:
+                impostors.update(lod_selector.levels == impostor_level)
+            if terrain_lod is not None:
+                terrain_lod.update(viewPos)
 
         view = tr.lookAt(
             viewPos,
-            np.array([0,0,0]),
+            camera_center,
             np.array([0,0,1])
         )
 
@@ -386,31 +1077,41 @@ if __name__ == "__main__":
         # Draw Tree
         glUseProgram(phongPipeline.shaderProgram)
 
-        # White light in all components: ambient, diffuse and specular.
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "La"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ld"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ls"), 1.0, 1.0, 1.0)
-
-        # Object is barely visible at only ambient. Diffuse behavior is slightly red. Sparkles are white
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ka"), 0.3, 0.3, 0.3)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Kd"), 0.9, 0.5, 0.5)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ks"), 0.05, 0.05, 0.05)
-
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "lightPosition"), -5, -5, 5)
+        set_phong_lights(phongPipeline)
         glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
-        glUniform1ui(glGetUniformLocation(phongPipeline.shaderProgram, "shininess"), 100)
-        
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "constantAttenuation"), 0.0001)
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "linearAttenuation"), 0.03)
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "quadraticAttenuation"), 0.01)
 
         glUniformMatrix4fv(glGetUniformLocation(phongPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
         glUniformMatrix4fv(glGetUniformLocation(phongPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
         
 
         sg.drawSceneGraphNode(forest, phongPipeline, "model")
+        if terrain_lod is not None:
+            glUniformMatrix4fv(glGetUniformLocation(phongPipeline.shaderProgram, "model"), 1, GL_TRUE, tr.identity())
+            terrain_lod.draw(phongPipeline)
+
+        # Draw terrain from its height texture
+        if terrain_heights is not None:
+            glUseProgram(displacementPipeline.shaderProgram)
+            set_phong_lights(displacementPipeline)
+            glUniform3f(glGetUniformLocation(displacementPipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
+            glUniformMatrix4fv(glGetUniformLocation(displacementPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+            glUniformMatrix4fv(glGetUniformLocation(displacementPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+            glUniformMatrix4fv(glGetUniformLocation(displacementPipeline.shaderProgram, "model"), 1, GL_TRUE, tr.identity())
+            displacementPipeline.drawShape(gpuTerrainGrid, terrain_heights)
+
+        # Draw distant trees
+        glUseProgram(impostorPipeline.shaderProgram)
+        glUniformMatrix4fv(glGetUniformLocation(impostorPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+        glUniformMatrix4fv(glGetUniformLocation(impostorPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+        glUniform3f(glGetUniformLocation(impostorPipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
+        if world is not None:
+            world.draw_impostors(impostorPipeline, atlas)
+        else:
+            impostors.draw(impostorPipeline, atlas)
         # Once the render is done, buffers are swapped, showing only the complete scene.
         glfw.swap_buffers(window)
 
+    if world is not None:
+        world.executor.shutdown(wait=False, cancel_futures=True)
     
     glfw.terminate()
\ No newline at end of file
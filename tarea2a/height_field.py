@@ -0,0 +1,66 @@
+import numpy as np
+
+# A class to sample a terrain height function once on a grid
+class HeightField(object):
+    def __init__(self, fz, width, lenght, spu):
+        # Heights and gradients are stored at the grid vertices and
+        # interpolated bilinearly, points outside the grid use its border
+        # fz - Height function fz(x,y)->z, evaluated over arrays of points.
+        #      If it has a height_and_gradient(x,y) or gradient(x,y) method
+        #      it gives the gradients, otherwise they come from the grid
+        # width - Terrain width, centered at x=0
+        # lenght - Terrain lenght, centered at y=0
+        # spu - Grid squares per unit
+        assert(spu>0)
+        self.w_n = int(width*spu) +1
+        self.l_n = int(lenght*spu) +1
+        self.x0 = -width/2
+        self.y0 = -lenght/2
+        self.dx = width/(self.w_n-1)
+        self.dy = lenght/(self.l_n-1)
+        x, y = np.meshgrid(self.x0 + np.arange(self.w_n)*self.dx,
+                           self.y0 + np.arange(self.l_n)*self.dy, indexing='ij')
+        if hasattr(fz, "height_and_gradient"):
+            heights, dfdx, dfdy = fz.height_and_gradient(x, y)
+        elif hasattr(fz, "gradient"):
+            heights = fz(x, y)
+            dfdx, dfdy = fz.gradient(x, y)
+        else:
+            heights = fz(x, y)
+            dfdx, dfdy = np.gradient(np.broadcast_to(heights, x.shape), self.dx, self.dy)
+        # (w_n,l_n,3) array of height and partial derivatives
+        self.samples = np.stack([np.broadcast_to(a, x.shape) for a in (heights, dfdx, dfdy)], axis=2)
+
+    def _interpolate(self, x, y):
+        # Method to interpolate the grid samples
+        # x, y - Arrays of positions
+        # return - (...,3) array of height and partial derivatives
+        u = np.clip((np.asarray(x, dtype=np.float64) - self.x0)/self.dx, 0, self.w_n-1)
+        v = np.clip((np.asarray(y, dtype=np.float64) - self.y0)/self.dy, 0, self.l_n-1)
+        i = np.minimum(np.floor(u).astype(np.int64), self.w_n-2)
+        j = np.minimum(np.floor(v).astype(np.int64), self.l_n-2)
+        s = (u - i)[...,np.newaxis]
+        t = (v - j)[...,np.newaxis]
+        return ((1-s)*(1-t)*self.samples[i,j] + s*(1-t)*self.samples[i+1,j] +
+                (1-s)*t*self.samples[i,j+1] + s*t*self.samples[i+1,j+1])
+
+    def __call__(self, x, y):
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - Terrain height at x,y
+        return self._interpolate(x, y)[...,0]
+
+    def gradient(self, x, y):
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - Partial derivatives of the terrain at x,y
+        samples = self._interpolate(x, y)
+        return samples[...,1], samples[...,2]
+
+    def normal(self, x, y):
+        # x - x position, or array of positions
+        # y - y position, or array of positions
+        # return - (...,3) array of unit normals at x,y
+        samples = self._interpolate(x, y)
+        normals = np.stack((-samples[...,1], -samples[...,2], np.ones(samples.shape[:-1])), axis=-1)
+        return normals/np.linalg.norm(normals, axis=-1)[...,np.newaxis]
@@ -9,9 +9,55 @@ class OBJModel(object):
         # vertices - List of 3d points
         # normal - List of 3d vector normal for each vertex
         # faces - List of vertex association
-        self.vertices = vertices
-        self.normals = normals
-        self.faces = faces
+        self._vertices = vertices
+        self._normals = normals
+        self._faces = faces
+        # Models created from numpy arrays keep them until the lists are used
+        self._arrays = None
+
+    def _to_lists(self):
+        # Create the lists of a model stored as arrays
+        if self._arrays is None:
+            return
+        vertices, normals, faces = self._arrays
+        self._arrays = None
+        # Faces have no texture coordinates
+        obj_faces = np.empty(faces.shape[:2] + (3,), dtype=object)
+        obj_faces[:,:,0] = faces[:,:,0]
+        obj_faces[:,:,2] = faces[:,:,1]
+        self._vertices = vertices.tolist()
+        self._normals = normals.tolist()
+        self._faces = obj_faces.tolist()
+
+    @property
+    def vertices(self):
+        self._to_lists()
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self._to_lists()
+        self._vertices = vertices
+
+    @property
+    def normals(self):
+        self._to_lists()
+        return self._normals
+
+    @normals.setter
+    def normals(self, normals):
+        self._to_lists()
+        self._normals = normals
+
+    @property
+    def faces(self):
+        self._to_lists()
+        return self._faces
+
+    @faces.setter
+    def faces(self, faces):
+        self._to_lists()
+        self._faces = faces
 
     def to_file(self, file_name:str):
         # Write model to file in OBJ format
@@ -94,6 +140,76 @@ class OBJModel(object):
 
         return OBJModel(new_vertices.tolist(), new_normals.tolist(), copy.deepcopy(self.faces))
 
+    def to_arrays(self):
+        # Get the model as numpy arrays
+        # return - (V,3) vertices, (N,3) normals and (F,3,2) faces with
+        #          the vertex and normal index (starting at 1) of each corner
+        if self._arrays is not None:
+            return self._arrays
+        vertices = np.array(self.vertices, dtype=np.float64).reshape(-1, 3)
+        normals = np.array(self.normals, dtype=np.float64).reshape(-1, 3)
+        faces = np.array([[[v[0], v[2]] for v in face] for face in self.faces],
+                         dtype=np.int64).reshape(-1, 3, 2)
+        return vertices, normals, faces
+
+def from_arrays(vertices, normals, faces) -> OBJModel:
+    # Create an OBJ model from numpy arrays
+    # The arrays are used as they are, lists are created only if needed
+    # vertices - (V,3) array of 3d points
+    # normals - (N,3) array of normal vectors
+    # faces - (F,3,2) array of vertex and normal indices (starting at 1)
+    # return - OBJModel
+    model = OBJModel(None, None, None)
+    model._arrays = (np.asarray(vertices, dtype=np.float64).reshape(-1, 3),
+                     np.asarray(normals, dtype=np.float64).reshape(-1, 3),
+                     np.asarray(faces, dtype=np.int64).reshape(-1, 3, 2))
+    return model
+
+def concatenate_arrays(arrays):
+    # Merge many models given as arrays into one
+    # arrays - List of (vertices, normals, faces) tuples, as returned by to_arrays
+    # return - Vertices, normals and faces arrays of the merged model
+    n_vertices = [len(v) for v, _, _ in arrays]
+    n_normals = [len(n) for _, n, _ in arrays]
+    n_faces = [len(f) for _, _, f in arrays]
+    vertices = np.empty((sum(n_vertices), 3))
+    normals = np.empty((sum(n_normals), 3))
+    faces = np.empty((sum(n_faces), 3, 2), dtype=np.int64)
+    # Start of each model in the merged arrays
+    v_start = np.concatenate([[0], np.cumsum(n_vertices)])
+    n_start = np.concatenate([[0], np.cumsum(n_normals)])
+    f_start = np.concatenate([[0], np.cumsum(n_faces)])
+    for i, (v, n, f) in enumerate(arrays):
+        vertices[v_start[i]:v_start[i+1]] = v
+        normals[n_start[i]:n_start[i+1]] = n
+        faces[f_start[i]:f_start[i+1]] = f + [v_start[i], n_start[i]]
+    return vertices, normals, faces
+
+def concatenate(models) -> OBJModel:
+    # Merge many models into a new one, same as joining them one by one
+    # models - List of OBJModel
+    # return - New OBJModel
+    return from_arrays(*concatenate_arrays([model.to_arrays() for model in models]))
+
+def transform_arrays(vertices, normals, faces, matrices):
+    # Transform a model once for each matrix and merge the copies
+    # vertices, normals, faces - Model arrays, as returned by to_arrays
+    # matrices - (K,4,4) array of transformation matrices
+    # return - Vertices, normals and faces arrays of the K merged copies
+    matrices = np.asarray(matrices, dtype=np.float64)
+    K = len(matrices)
+    A = matrices[:,:3,:3]
+    new_vertices = np.einsum('kij,vj->kvi', A, vertices) + matrices[:,np.newaxis,:3,3]
+    # Normals use the inverse transpose of the linear part
+    G = np.linalg.inv(A).transpose(0, 2, 1)
+    new_normals = np.einsum('kij,nj->kni', G, normals)
+    new_normals /= np.linalg.norm(new_normals, axis=2)[:,:,np.newaxis]
+    # Each copy indexes its own vertices and normals
+    offsets = np.arange(K)[:,np.newaxis]*[len(vertices), len(normals)]
+    new_faces = faces[np.newaxis] + offsets[:,np.newaxis,np.newaxis,:]
+    return (new_vertices.reshape(-1, 3), new_normals.reshape(-1, 3),
+            new_faces.reshape(-1, 3, 2))
+
 def cubeOBJ():
     # A 3D cube in OBJ format
     # Defining the location of each vertex  of the shape
@@ -0,0 +1,195 @@
+# coding=utf-8
+"""
+Terrain drawn from a height texture, displaced in the vertex shader
+"""
+
+from OpenGL.GL import *
+import OpenGL.GL.shaders
+import numpy as np
+
+import basic_shapes as bs
+from easy_shaders import GPUShape
+
+
+def createGridMesh(w_n, l_n):
+    # A flat grid between (0,0) and (1,1), the shader places and displaces it
+    # w_n - Number of vertices along x
+    # l_n - Number of vertices along y
+    # return - Shape with 2d grid coordinates
+    u, v = np.meshgrid(np.linspace(0, 1, w_n), np.linspace(0, 1, l_n), indexing='ij')
+    vertices = np.column_stack((u.ravel(), v.ravel()))
+
+    index = np.arange(w_n*l_n).reshape(w_n, l_n)
+    a = index[:-1,:-1].ravel()
+    b = index[1:,:-1].ravel()
+    c = index[1:,1:].ravel()
+    d = index[:-1,1:].ravel()
+    indices = np.column_stack((a, b, c, c, d, a))
+
+    return bs.Shape(vertices.ravel(), indices.ravel())
+
+
+# A class to keep the terrain heights in a float texture
+class HeightTexture(object):
+    def __init__(self, heights, width, lenght):
+        # Texel (i,j) is the height at x = -width/2 + i*dx, y = -lenght/2 + j*dy
+        # heights - (w_n,l_n) array of heights, as HeightField.samples[...,0]
+        # width - Terrain width, centered at x=0
+        # lenght - Terrain lenght, centered at y=0
+        heights = np.asarray(heights)
+        self.w_n, self.l_n = heights.shape
+        self.width = width
+        self.lenght = lenght
+
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        # Rows of the texture go along y
+        data = np.ascontiguousarray(heights.T, dtype=np.float32)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, self.w_n, self.l_n, 0,
+                     GL_RED, GL_FLOAT, data)
+
+    def update(self, heights, i=0, j=0):
+        # Method to replace a block of heights, the terrain changes in the next frame
+        # heights - (a,b) array of heights
+        # i, j - Grid indices of the first height of the block
+        heights = np.asarray(heights)
+        data = np.ascontiguousarray(heights.T, dtype=np.float32)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, i, j, heights.shape[0], heights.shape[1],
+                        GL_RED, GL_FLOAT, data)
+
+
+class DisplacementPhongShaderProgram:
+    # Phong shader for a grid of createGridMesh. Heights come from a
+    # HeightTexture, normals from the differences of neighbour texels.
+    # Uses the same light and material uniforms as SimplePhongShaderProgram.
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec2 gridPosition;
+
+            out vec3 fragPosition;
+            out vec3 fragNormal;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+            uniform sampler2D heightMap;
+            uniform vec2 terrainSize;
+
+            // Height at a point given in texel units, texel (i,j) is at (i,j)
+            float heightAt(vec2 texel, vec2 texels)
+            {
+                return texture(heightMap, (texel + 0.5) / texels).r;
+            }
+
+            void main()
+            {
+                // Vertices of the grid border fall on the texel centers of the border
+                vec2 texels = vec2(textureSize(heightMap, 0));
+                vec2 texel = gridPosition * (texels - 1.0);
+                vec2 spacing = terrainSize / (texels - 1.0);
+
+                vec3 position = vec3((gridPosition - 0.5) * terrainSize, heightAt(texel, texels));
+                // Central differences inside, one-sided differences on the border texels
+                vec2 low = max(texel - 1.0, 0.0);
+                vec2 high = min(texel + 1.0, texels - 1.0);
+                float dfdx = (heightAt(vec2(high.x, texel.y), texels) - heightAt(vec2(low.x, texel.y), texels)) / ((high.x - low.x) * spacing.x);
+                float dfdy = (heightAt(vec2(texel.x, high.y), texels) - heightAt(vec2(texel.x, low.y), texels)) / ((high.y - low.y) * spacing.y);
+                vec3 normal = vec3(-dfdx, -dfdy, 1.0);
+
+                fragPosition = vec3(model * vec4(position, 1.0));
+                fragNormal = mat3(transpose(inverse(model))) * normal;
+
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = """
+            #version 330 core
+
+            out vec4 fragColor;
+
+            in vec3 fragNormal;
+            in vec3 fragPosition;
+
+            uniform vec3 terrainColor;
+            uniform vec3 lightPosition;
+            uniform vec3 viewPosition;
+            uniform vec3 La;
+            uniform vec3 Ld;
+            uniform vec3 Ls;
+            uniform vec3 Ka;
+            uniform vec3 Kd;
+            uniform vec3 Ks;
+            uniform uint shininess;
+            uniform float constantAttenuation;
+            uniform float linearAttenuation;
+            uniform float quadraticAttenuation;
+
+            void main()
+            {
+                // ambient
+                vec3 ambient = Ka * La;
+
+                // diffuse
+                vec3 normalizedNormal = normalize(fragNormal);
+                vec3 toLight = lightPosition - fragPosition;
+                vec3 lightDir = normalize(toLight);
+                float diff = max(dot(normalizedNormal, lightDir), 0.0);
+                vec3 diffuse = Kd * Ld * diff;
+
+                // specular
+                vec3 viewDir = normalize(viewPosition - fragPosition);
+                vec3 reflectDir = reflect(-lightDir, normalizedNormal);
+                float spec = pow(max(dot(viewDir, reflectDir), 0.0), shininess);
+                vec3 specular = Ks * Ls * spec;
+
+                // attenuation
+                float distToLight = length(toLight);
+                float attenuation = constantAttenuation
+                    + linearAttenuation * distToLight
+                    + quadraticAttenuation * distToLight * distToLight;
+
+                vec3 result = (ambient + ((diffuse + specular) / attenuation)) * terrainColor;
+                fragColor = vec4(result, 1.0);
+            }
+            """
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, heights, color=(0,0.5,0.3), mode=GL_TRIANGLES):
+        # shape - GPUShape of createGridMesh
+        # heights - HeightTexture of the terrain
+        # color - Color of the terrain
+        assert isinstance(shape, GPUShape)
+
+        glUniform2f(glGetUniformLocation(self.shaderProgram, "terrainSize"), heights.width, heights.lenght)
+        glUniform3f(glGetUniformLocation(self.shaderProgram, "terrainColor"), *color)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, heights.texture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "heightMap"), 0)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        # 2d grid position => 2*4 = 8 bytes
+        gridPosition = glGetAttribLocation(self.shaderProgram, "gridPosition")
+        glVertexAttribPointer(gridPosition, 2, GL_FLOAT, GL_FALSE, 8, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(gridPosition)
+
+        # Render the active element buffer with the active shader program
+        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
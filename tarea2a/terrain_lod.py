@@ -0,0 +1,209 @@
+# coding=utf-8
+"""
+Terrain drawn in tiles with a level of detail per tile (geomipmapping)
+"""
+
+from OpenGL.GL import *
+import numpy as np
+
+import easy_shaders as es
+
+# Bits of the tile edges whose neighbour is coarser
+EDGE_LEFT = 1
+EDGE_RIGHT = 2
+EDGE_BOTTOM = 4
+EDGE_TOP = 8
+
+
+def tile_indices(tile_size, level, edges):
+    # Function to create the triangles of a tile at a level of detail
+    # Vertices of the tile are numbered i*(tile_size+1) + j for the point (i,j),
+    # i along x and j along y.
+    # The level uses every 2**level vertex, on the edges marked in edges the
+    # odd vertices of the level are collapsed into the previous even one, so
+    # the edge matches a neighbour one level coarser without cracks
+    # tile_size - Number of squares by side of a tile, a power of 2
+    # level - Level of detail, 0 uses every vertex
+    # edges - Bits of the edges to stitch, EDGE_LEFT | EDGE_RIGHT...
+    # return - (F,3) array of vertex indices
+    step = 2**level
+    n = tile_size + 1
+    points = np.arange(0, n, step)
+    # Position of each point of the level after the collapse
+    pi, pj = np.meshgrid(points, points, indexing='ij')
+    si, sj = pi.copy(), pj.copy()
+    if step < tile_size:
+        odd = (points // step) % 2 == 1
+        if edges & EDGE_LEFT:
+            sj[0, odd] -= step
+        if edges & EDGE_RIGHT:
+            sj[-1, odd] -= step
+        if edges & EDGE_BOTTOM:
+            si[odd, 0] -= step
+        if edges & EDGE_TOP:
+            si[odd, -1] -= step
+    index = si*n + sj
+    # Two triangles for every square of the level
+    a = index[:-1,:-1].ravel()
+    b = index[1:,:-1].ravel()
+    c = index[1:,1:].ravel()
+    d = index[:-1,1:].ravel()
+    faces = np.concatenate((np.column_stack((a, b, c)), np.column_stack((c, d, a))))
+    # Collapsed triangles are removed
+    keep = (faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,2] != faces[:,0])
+    return faces[keep]
+
+
+def limit_neighbour_levels(levels):
+    # Function to make neighbour tiles differ by at most one level,
+    # tiles are refined until they are not two levels coarser than a neighbour
+    # levels - (nx,ny) array of tile levels
+    # return - (nx,ny) array of tile levels
+    levels = levels.copy()
+    for _ in range(int(levels.max(initial=0)) + 1):
+        limit = levels.copy()
+        limit[1:] = np.minimum(limit[1:], levels[:-1] + 1)
+        limit[:-1] = np.minimum(limit[:-1], levels[1:] + 1)
+        limit[:,1:] = np.minimum(limit[:,1:], levels[:,:-1] + 1)
+        limit[:,:-1] = np.minimum(limit[:,:-1], levels[:,1:] + 1)
+        if np.array_equal(limit, levels):
+            break
+        levels = limit
+    return levels
+
+
+def coarser_edges(levels):
+    # Function to find the edges of each tile whose neighbour is coarser
+    # levels - (nx,ny) array of tile levels
+    # return - (nx,ny) array of edge bits
+    # Left and right are the -x and +x neighbours, bottom and top the -y and +y ones
+    edges = np.zeros(levels.shape, dtype=np.int64)
+    edges[1:] |= np.where(levels[:-1] > levels[1:], EDGE_LEFT, 0)
+    edges[:-1] |= np.where(levels[1:] > levels[:-1], EDGE_RIGHT, 0)
+    edges[:,1:] |= np.where(levels[:,:-1] > levels[:,1:], EDGE_BOTTOM, 0)
+    edges[:,:-1] |= np.where(levels[:,1:] > levels[:,:-1], EDGE_TOP, 0)
+    return edges
+
+
+# A class to draw a height field in tiles with a level of detail per tile
+class TerrainLOD(object):
+    def __init__(self, fz, width, lenght, tile_size=16, tiles_per_unit=1,
+                 max_triangles=20000, color=(0,0.5,0.3)):
+        # fz - HeightField of the terrain, or any function with a normal(x,y) method
+        # width - Terrain width, centered at x=0
+        # lenght - Terrain lenght, centered at y=0
+        # tile_size - Number of squares by side of a tile, a power of 2
+        # tiles_per_unit - Number of tiles by unit of lenght
+        # max_triangles - Number of triangles drawn in a frame
+        # color - Color of the terrain
+        assert(tile_size > 0 and tile_size & (tile_size - 1) == 0)
+        self.tile_size = tile_size
+        self.max_level = int(np.log2(tile_size))
+        self.max_triangles = max_triangles
+        self.tiles = (max(int(np.ceil(width*tiles_per_unit)), 1),
+                      max(int(np.ceil(lenght*tiles_per_unit)), 1))
+        tile_w = width/self.tiles[0]
+        tile_l = lenght/self.tiles[1]
+        # Tile centers, for the level of detail
+        cx = -width/2 + (np.arange(self.tiles[0]) + 0.5)*tile_w
+        cy = -lenght/2 + (np.arange(self.tiles[1]) + 0.5)*tile_l
+        cx, cy = np.meshgrid(cx, cy, indexing='ij')
+        self.centers = np.column_stack((cx.ravel(), cy.ravel(), fz(cx.ravel(), cy.ravel())))
+
+        # Every tile has its own (tile_size+1)^2 vertices, tile k starts at vertex k*(tile_size+1)^2
+        n = tile_size + 1
+        u = np.arange(n)/tile_size
+        ti, tj, i, j = np.meshgrid(np.arange(self.tiles[0]), np.arange(self.tiles[1]),
+                                   u, u, indexing='ij')
+        x = (-width/2 + (ti + i)*tile_w).ravel()
+        y = (-lenght/2 + (tj + j)*tile_l).ravel()
+        vertex_data = np.column_stack((x, y, fz(x, y), np.tile(color, (len(x), 1)),
+                                       fz.normal(x, y))).astype(np.float32)
+        self.vertices_per_tile = n*n
+
+        # Index patterns of every level and stitched edges, in one buffer
+        patterns = []
+        self.pattern_offset = np.zeros((self.max_level + 1, 16), dtype=np.int64)
+        self.pattern_size = np.zeros((self.max_level + 1, 16), dtype=np.int64)
+        offset = 0
+        for level in range(self.max_level + 1):
+            for edges in range(16):
+                faces = tile_indices(tile_size, level, edges).ravel()
+                patterns.append(faces)
+                self.pattern_offset[level, edges] = offset
+                self.pattern_size[level, edges] = len(faces)
+                offset += len(faces)
+        indices = np.concatenate(patterns).astype(np.uint32)
+        # Triangles of an unstitched tile at each level
+        self.level_triangles = self.pattern_size[:,0]//3
+
+        self.gpuShape = es.GPUShape()
+        self.gpuShape.vao = glGenVertexArrays(1)
+        self.gpuShape.vbo = glGenBuffers(1)
+        self.gpuShape.ebo = glGenBuffers(1)
+        self.gpuShape.size = len(indices)
+        glBindBuffer(GL_ARRAY_BUFFER, self.gpuShape.vbo)
+        glBufferData(GL_ARRAY_BUFFER, vertex_data.nbytes, vertex_data, GL_STATIC_DRAW)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.gpuShape.ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+
+        self.levels = np.zeros(self.tiles, dtype=np.int64)
+        self.edges = np.zeros(self.tiles, dtype=np.int64)
+
+    def select_levels(self, view_pos):
+        # Method to choose the level of each tile from the camera position
+        # A tile at distance d uses the level log2(d/d0), d0 is the largest
+        # distance that keeps the terrain in the triangle budget
+        # view_pos - Camera position
+        # return - (nx,ny) array of tile levels
+        distance = np.maximum(np.linalg.norm(self.centers - view_pos, axis=1), 1e-6)
+
+        def levels_for(d0):
+            levels = np.clip(np.floor(np.log2(distance/d0)) + 1, 0, self.max_level)
+            return limit_neighbour_levels(levels.astype(np.int64).reshape(self.tiles))
+
+        # Bisection of log2(d0), more detail with a larger d0
+        low, high = -20.0, 20.0
+        for _ in range(30):
+            mid = 0.5*(low + high)
+            if np.sum(self.level_triangles[levels_for(2**mid)]) <= self.max_triangles:
+                low = mid
+            else:
+                high = mid
+        return levels_for(2**low)
+
+    def update(self, view_pos):
+        # Method to choose the levels of the tiles, done every frame
+        # view_pos - Camera position
+        self.levels = self.select_levels(view_pos)
+        self.edges = coarser_edges(self.levels)
+
+    def triangle_count(self):
+        # return - Number of triangles drawn with the chosen levels
+        return int(np.sum(self.pattern_size[self.levels, self.edges])//3)
+
+    def draw(self, pipeline):
+        # Method to draw every tile with its level
+        # pipeline - SimplePhongShaderProgram in use, with the model uniform set
+        glBindVertexArray(self.gpuShape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.gpuShape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.gpuShape.ebo)
+
+        # 3d vertices + rgb color + 3d normals => 3*4 + 3*4 + 3*4 = 36 bytes
+        position = glGetAttribLocation(pipeline.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        color = glGetAttribLocation(pipeline.shaderProgram, "color")
+        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(color)
+
+        normal = glGetAttribLocation(pipeline.shaderProgram, "normal")
+        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 36, ctypes.c_void_p(24))
+        glEnableVertexAttribArray(normal)
+
+        for k, (level, edges) in enumerate(zip(self.levels.ravel(), self.edges.ravel())):
+            offset = int(self.pattern_offset[level, edges])*es.SIZE_IN_BYTES
+            glDrawElementsBaseVertex(GL_TRIANGLES, int(self.pattern_size[level, edges]),
+                                     GL_UNSIGNED_INT, ctypes.c_void_p(offset),
+                                     k*self.vertices_per_tile)
@@ -175,7 +175,6 @@ class FractalTree3D:
                     branch_side = np.matmul(branch_side, rotM2[:3,:3])
             branch_origin += seg_length*direction
 
-
 def get_tree_model(tree: FractalTree3D, branch_model: ob.OBJModel,
                     leaf_model: ob.OBJModel) -> ob.OBJModel:
     # Creaates a 3d obj model from a fractal tree and 
@@ -199,15 +198,105 @@ def get_tree_model(tree: FractalTree3D, branch_model: ob.OBJModel,
                 l_M = child.get_leaf_transform()
                 leaf_list.append(leaf_model.transform(l_M))
 
-    tree_model = branches_list[0]
-    leaves_model = leaf_list[0]
-    for i in range(1,len(branches_list)):
-        tree_model.join(branches_list[i])
-    for leaf in leaf_list:
-        leaves_model.join(leaf)
+    tree_model = ob.concatenate(branches_list)
+    leaves_model = ob.concatenate(leaf_list)
 
     return tree_model, leaves_model
 
+def _empty_arrays():
+    # return - Arrays of a model without vertices
+    return np.zeros((0,3)), np.zeros((0,3)), np.zeros((0,3,2), dtype=np.int64)
+
+# A class to build each distinct subtree of a fractal tree only once
+class SubtreeCache:
+    def __init__(self, split_ang, split_n, decr, sides_n, branch_model, leaf_model):
+        # Subtrees with the same recursion level, height and diameter are
+        # congruent, they are built once in a canonical frame: origin at 0,
+        # direction z and side y, and then placed with rigid transforms
+        # split_ang, split_n, decr, sides_n - Tree parameters, as in FractalTree3D
+        # branch_model - OBJ model for the branches and trunk
+        # leaf_model - OBJ model for the leaves
+        self.split_n = split_n
+        self.branch_arrays = branch_model.to_arrays()
+        self.leaf_arrays = leaf_model.to_arrays()
+        self.cache = {}
+        # Position of the splits along a trunk of height 1
+        weights = decr**np.arange(split_n+1)
+        seg_length = 1/np.sum(weights)
+        self.split_pos = seg_length*np.cumsum(weights)[:split_n]
+        self.split_len = seg_length*weights[1:]
+        # Frames of the lateral branches in the canonical frame
+        direction = np.array([0.0, 0.0, 1.0])
+        side = np.array([0.0, 1.0, 0.0])
+        rotM1 = tr.rotationA(split_ang, side)[:3,:3]
+        rotM2 = tr.rotationA(2*np.pi/sides_n, direction)[:3,:3]
+        branch_dir = np.matmul(direction, rotM1)
+        branch_side = np.matmul(side, rotM1)
+        self.frames = np.zeros((sides_n, 4, 4))
+        for j in range(sides_n):
+            child_dir = branch_dir/np.linalg.norm(branch_dir)
+            up = np.cross(branch_side, child_dir)
+            child_side = np.cross(child_dir, up)
+            child_side = child_side/np.linalg.norm(child_side)
+            self.frames[j,:3,0] = up/np.linalg.norm(up)
+            self.frames[j,:3,1] = child_side
+            self.frames[j,:3,2] = child_dir
+            self.frames[j,3,3] = 1
+            branch_dir = np.matmul(branch_dir, rotM2)
+            branch_side = np.matmul(branch_side, rotM2)
+
+    def _parts(self, rec_level, height, diameter):
+        # Method to split a subtree in its trunk and its lateral subtrees
+        # rec_level, height, diameter - Subtree parameters
+        # return - Trunk branch and leaf arrays, and a list of
+        #          (rec_level, height, diameter, (K,4,4) transforms) of the lateral subtrees
+        trunk_M = np.diag([diameter, diameter, height, 1.0])
+        trunk_M[2,3] = height/2
+        trunk = ob.transform_arrays(*self.branch_arrays, trunk_M[np.newaxis])
+        # Leaves grow on the trunks without lateral branches
+        if rec_level == 0 or self.split_n == 0:
+            leaf_M = np.diag([8*diameter, 8*diameter, height, 1.0])
+            leaf_M[2,3] = height
+            return trunk, ob.transform_arrays(*self.leaf_arrays, leaf_M[np.newaxis]), []
+        children = []
+        for pos, length in zip(self.split_pos, self.split_len):
+            transforms = self.frames.copy()
+            transforms[:,2,3] = height*pos
+            children.append((rec_level-1, height*length, 0.5*diameter, transforms))
+        return trunk, _empty_arrays(), children
+
+    def get(self, rec_level, height, diameter):
+        # Method to get the mesh of a subtree in the canonical frame
+        # rec_level - Recursion level of the subtree
+        # height - Height of the subtree trunk
+        # diameter - Diameter of the subtree trunk
+        # return - Branch arrays and leaf arrays, as returned by OBJModel.to_arrays
+        key = (rec_level, round(height, 12), round(diameter, 12))
+        if key not in self.cache:
+            trunk, leaves, children = self._parts(rec_level, height, diameter)
+            branch_list = [trunk]
+            leaf_list = [leaves]
+            for child_rec, child_height, child_diameter, transforms in children:
+                child_branches, child_leaves = self.get(child_rec, child_height, child_diameter)
+                branch_list.append(ob.transform_arrays(*child_branches, transforms))
+                leaf_list.append(ob.transform_arrays(*child_leaves, transforms))
+            self.cache[key] = (ob.concatenate_arrays(branch_list),
+                               ob.concatenate_arrays(leaf_list))
+        return self.cache[key]
+
+def get_tree_model_memo(height, split_ang, split_n, decr, rec_level, sides_n,
+                        base_diameter, branch_model: ob.OBJModel, leaf_model: ob.OBJModel):
+    # Creates the model of a fractal tree, building each distinct subtree once
+    # The tree has the default origin, direction and side of FractalTree3D
+    # height, split_ang, split_n, decr, rec_level, sides_n, base_diameter - Tree
+    #     parameters, as in FractalTree3D
+    # branch_model - OBJ model for the branches and trunk
+    # leaf_model - OBJ model for the leaves
+    # return - Tree and leaves OBJ models
+    cache = SubtreeCache(split_ang, split_n, decr, sides_n, branch_model, leaf_model)
+    branches, leaves = cache.get(rec_level, height, base_diameter)
+    return ob.from_arrays(*branches), ob.from_arrays(*leaves)
+
 def get_tree_model_sg(tree_obj: ob.OBJModel, leaves_obj: ob.OBJModel,
                         tree_color: tuple, leaves_color: tuple) -> sg.SceneGraphNode:
     # Generate a scenegraph node of the tree with leaves
@@ -264,13 +353,13 @@ if __name__ == "__main__":
 
     print("Generating tree ...")
     # Create a tree
-    tree = FractalTree3D(height=1.0, split_ang=np.deg2rad(args.split_ang), 
-                        split_n=args.split_n, decr=args.decr, rec_level=args.rec_level, 
-                        sides_n=args.sides_n, base_diameter=args.base_diameter)
     # branch model
     branch_model = ob.cilinderOBJ(num_vertex=8)
     leaf_model = ob.leafOBJ()
-    tree_obj, leaves_obj = get_tree_model(tree, branch_model, leaf_model)
+    tree_obj, leaves_obj = get_tree_model_memo(height=1.0, split_ang=np.deg2rad(args.split_ang),
+                        split_n=args.split_n, decr=args.decr, rec_level=args.rec_level,
+                        sides_n=args.sides_n, base_diameter=args.base_diameter,
+                        branch_model=branch_model, leaf_model=leaf_model)
 
 
     print("Tree ready!")
@@ -0,0 +1,87 @@
+import hashlib
+import os
+
+import numpy as np
+
+import obj_model as ob
+
+# A class to store generated tree meshes on disk, so a species is built only once
+class TreeMeshCache(object):
+    def __init__(self, directory, max_bytes=256*2**20):
+        # Each tree is stored as an uncompressed npz file with float64 vertices
+        # and normals and int32 faces, so a stored tree equals a built one.
+        # Files are touched when read, the least recently used ones are
+        # removed while the cache is over its size
+        # directory - Folder of the cache files, created if needed
+        # max_bytes - Maximum size of the cache in disk
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(height, split_ang, split_n, decr, rec_level, sides_n, base_diameter, num_vertex):
+        # Method to create the key of a tree
+        # height, split_ang, split_n, decr, rec_level, sides_n, base_diameter - Tree
+        #     parameters, as in FractalTree3D
+        # num_vertex - Number of vertices of the branch cilinder
+        # return - Key tuple
+        return (float(height), float(split_ang), int(split_n), float(decr),
+                int(rec_level), int(sides_n), float(base_diameter), int(num_vertex))
+
+    def _path(self, key):
+        # Method to get the file name of a key
+        # key - Key tuple, as returned by TreeMeshCache.key
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + ".npz")
+
+    def get(self, key):
+        # Method to load a tree from the cache
+        # key - Key tuple, as returned by TreeMeshCache.key
+        # return - Tree and leaves OBJ models, or None if the tree is not stored
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                # Files with the same hash but another key are not used
+                if tuple(data["key"].tolist()) != key:
+                    return None
+                tree_obj = ob.from_arrays(data["tree_vertices"], data["tree_normals"],
+                                          data["tree_faces"])
+                leaves_obj = ob.from_arrays(data["leaves_vertices"], data["leaves_normals"],
+                                            data["leaves_faces"])
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)
+        return tree_obj, leaves_obj
+
+    def put(self, key, tree_obj: ob.OBJModel, leaves_obj: ob.OBJModel):
+        # Method to store a tree in the cache
+        # key - Key tuple, as returned by TreeMeshCache.key
+        # tree_obj - Tree OBJ model
+        # leaves_obj - Leaves OBJ model
+        arrays = {"key": np.array(key, dtype=np.float64)}
+        for name, model in (("tree", tree_obj), ("leaves", leaves_obj)):
+            vertices, normals, faces = model.to_arrays()
+            arrays[name + "_vertices"] = vertices.astype(np.float64)
+            arrays[name + "_normals"] = normals.astype(np.float64)
+            arrays[name + "_faces"] = faces.astype(np.int32)
+        path = self._path(key)
+        # Write to a temporary file so readers never see half a tree
+        temp_path = path[:-len(".npz")] + ".tmp.npz"
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        # Method to remove the least recently used trees while over the size
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        files.sort()
+        used_bytes = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if used_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            used_bytes -= size
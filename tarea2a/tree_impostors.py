@@ -0,0 +1,255 @@
+# coding=utf-8
+"""
+Billboard impostors for distant forest trees
+"""
+
+from OpenGL.GL import *
+import OpenGL.GL.shaders
+import numpy as np
+
+import transformations as tr
+import basic_shapes as bs
+import scene_graph as sg
+import easy_shaders as es
+from easy_shaders import GPUShape
+
+
+def createImpostorQuad():
+    # A unit quad with corners (0,0) and (1,1), the shader places it
+    # return - Shape with 2d quad coordinates
+    vertices = [
+        0.0, 0.0,
+        1.0, 0.0,
+        1.0, 1.0,
+        0.0, 1.0]
+
+    indices = [
+        0, 1, 2,
+        2, 3, 0]
+
+    return bs.Shape(vertices, indices)
+
+
+def model_bounds(trees_models, leaves_models):
+    # Function to get the size of the tree models
+    # trees_models - List of OBJ trees models
+    # leaves_models - List of OBJ leaves models
+    # return - (S,2) array with the horizontal radius and height of each model
+    bounds = []
+    for tree_obj, leaves_obj in zip(trees_models, leaves_models):
+        vertices = np.concatenate([tree_obj.to_arrays()[0], leaves_obj.to_arrays()[0]])
+        radius = np.max(np.linalg.norm(vertices[:,:2], axis=1))
+        bounds.append([radius, np.max(vertices[:,2])])
+    return np.array(bounds)
+
+
+# A class to render every species from several azimuths into one texture
+class ImpostorAtlas(object):
+    def __init__(self, bounds, views=8, tile_size=128):
+        # The atlas has one row per species and one column per view,
+        # view j is seen from the azimuth 2*pi*j/views
+        # bounds - (S,2) array with the radius and height of each species
+        # views - Number of azimuths rendered for each species
+        # tile_size - Size in pixels of the image of a view
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.views = views
+        self.tile_size = tile_size
+        self.width = views*tile_size
+        self.height = len(self.bounds)*tile_size
+
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, self.width, self.height, 0,
+                     GL_RGBA, GL_UNSIGNED_BYTE, None)
+
+        # The texture is the color attachment of an offscreen framebuffer
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, self.texture, 0)
+        self.depth = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, self.width, self.height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth)
+        assert glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def render(self, treeNodes, pipeline):
+        # Method to draw every view of every species, done once at startup
+        # The pipeline lights must be set before calling it
+        # treeNodes - List of scene graph nodes of the species
+        # pipeline - SimplePhongShaderProgram to draw the trees
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, self.width, self.height)
+        glClearColor(0.0, 0.0, 0.0, 0.0)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+
+        glUseProgram(pipeline.shaderProgram)
+        for i, node in enumerate(treeNodes):
+            radius, height = self.bounds[i]
+            # The image covers the quad drawn by ImpostorShaderProgram
+            projection = tr.ortho(-radius, radius, 0, height, 0.1, 2*radius + 0.2)
+            glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+            for j in range(self.views):
+                glViewport(j*self.tile_size, i*self.tile_size, self.tile_size, self.tile_size)
+                azimuth = 2*np.pi*j/self.views
+                eye = np.array([np.cos(azimuth), np.sin(azimuth), 0.0])*(radius + 0.1)
+                view = tr.lookAt(eye, np.array([0, 0, 0]), np.array([0, 0, 1]))
+                glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+                glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "viewPosition"), *eye)
+                sg.drawSceneGraphNode(node, pipeline, "model")
+
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glViewport(*viewport)
+
+
+class ImpostorShaderProgram:
+    # Draws camera facing quads textured with the ImpostorAtlas view closest
+    # to the camera azimuth. Quads rotate around the vertical axis only, so
+    # trees stay upright when the camera looks down.
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec2 corner;
+            // Per tree base position, radius, height and species
+            layout (location = 1) in vec3 treePosition;
+            layout (location = 2) in vec3 treeShape;
+
+            out vec2 fragTexCoord;
+
+            uniform mat4 projection;
+            uniform mat4 view;
+            uniform vec3 viewPosition;
+            uniform int views;
+            uniform int species;
+
+            const float PI = 3.14159265;
+
+            void main()
+            {
+                vec3 toCamera = viewPosition - treePosition;
+                toCamera.z = 0.0;
+                if (length(toCamera) < 1e-6)
+                    toCamera = vec3(1.0, 0.0, 0.0);
+                toCamera = normalize(toCamera);
+                vec3 right = cross(vec3(0.0, 0.0, 1.0), toCamera);
+
+                vec3 p = treePosition
+                    + (2.0 * corner.x - 1.0) * treeShape.x * right
+                    + corner.y * treeShape.y * vec3(0.0, 0.0, 1.0);
+                gl_Position = projection * view * vec4(p, 1.0);
+
+                // Closest rendered azimuth
+                float azimuth = atan(toCamera.y, toCamera.x);
+                int column = int(mod(round(azimuth * float(views) / (2.0 * PI)), float(views)));
+                fragTexCoord = vec2((float(column) + corner.x) / float(views),
+                                    (treeShape.z + corner.y) / float(species));
+            }
+            """
+
+        fragment_shader = """
+            #version 330 core
+
+            in vec2 fragTexCoord;
+
+            out vec4 outColor;
+
+            uniform sampler2D atlas;
+
+            void main()
+            {
+                vec4 texel = texture(atlas, fragTexCoord);
+                if (texel.a < 0.5)
+                    discard;
+                outColor = vec4(texel.rgb, 1.0);
+            }
+            """
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, atlas, instanceVBO, instances, mode=GL_TRIANGLES):
+        # shape - GPUShape of createImpostorQuad
+        # atlas - ImpostorAtlas with the rendered species
+        # instanceVBO - Buffer with 6 floats per tree: base position,
+        #               radius, height and species
+        # instances - Number of trees to draw
+        assert isinstance(shape, GPUShape)
+
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "views"), atlas.views)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "species"), len(atlas.bounds))
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, atlas.texture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "atlas"), 0)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        # 2d corner => 2*4 = 8 bytes
+        corner = glGetAttribLocation(self.shaderProgram, "corner")
+        glVertexAttribPointer(corner, 2, GL_FLOAT, GL_FALSE, 8, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(corner)
+
+        # 3d position + radius, height, species => 3*4 + 3*4 = 24 bytes per tree
+        glBindBuffer(GL_ARRAY_BUFFER, instanceVBO)
+        treePosition = glGetAttribLocation(self.shaderProgram, "treePosition")
+        glVertexAttribPointer(treePosition, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(treePosition)
+        glVertexAttribDivisor(treePosition, 1)
+
+        treeShape = glGetAttribLocation(self.shaderProgram, "treeShape")
+        glVertexAttribPointer(treeShape, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(treeShape)
+        glVertexAttribDivisor(treeShape, 1)
+
+        # Render the active element buffer with the active shader program
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, instances)
+
+
+# A class to keep the buffer of the trees drawn as impostors
+class ForestImpostors(object):
+    def __init__(self, positions, species, bounds, scale=0.5, gpuQuad=None):
+        # positions - (N,3) array of the tree base positions
+        # species - (N,) array with the species of each tree
+        # bounds - (S,2) array with the radius and height of each species
+        # scale - Scale factor for the trees
+        # gpuQuad - (optional) GPUShape of createImpostorQuad, shared between forests
+        bounds = scale*np.asarray(bounds, dtype=np.float64)
+        self.instances = np.column_stack((positions, bounds[species],
+                                          species)).astype(np.float32)
+        self.vbo = glGenBuffers(1)
+        self.size = 0
+        if gpuQuad is None:
+            gpuQuad = es.toGPUShape(createImpostorQuad())
+        self.gpuQuad = gpuQuad
+
+    def update(self, mask):
+        # Method to choose the trees drawn as impostors
+        # mask - (N,) boolean array of the trees to draw
+        instances = np.ascontiguousarray(self.instances[mask])
+        self.size = len(instances)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, instances.nbytes, instances, GL_DYNAMIC_DRAW)
+
+    def free(self):
+        # Method to free the buffer of the trees, the quad may be shared
+        glDeleteBuffers(1, [self.vbo])
+
+    def draw(self, pipeline, atlas):
+        # Method to draw the chosen trees in one instanced call
+        # pipeline - ImpostorShaderProgram in use
+        # atlas - ImpostorAtlas with the rendered species
+        if self.size == 0:
+            return
+        pipeline.drawShape(self.gpuQuad, atlas, self.vbo, self.size)
@@ -0,0 +1,72 @@
+import numpy as np
+
+def lod_parameters(rec_level, num_vertex, level):
+    # Function to get the tree parameters of a level of detail
+    # Each level prunes the deepest branches and removes cilinder sides, the
+    # leaves of a pruned tree grow on thicker branches, so they are bigger
+    # and stand for the cluster of leaves that was removed
+    # rec_level - Recursion level of the full detail tree
+    # num_vertex - Number of vertices of the full detail branch cilinder
+    # level - Level of detail, 0 is the full detail tree
+    # return - Recursion level and number of cilinder vertices of the level
+    return max(rec_level - level, 0), max(num_vertex - 2*level, 3)
+
+# A class to choose the level of detail of every tree of a forest
+class TreeLODSelector(object):
+    def __init__(self, positions, species, triangles, distances,
+                 hysteresis=0.1, max_triangles=None):
+        # positions - (N,3) array of the tree positions
+        # species - (N,) array with the species of each tree
+        # triangles - (S,L) array with the triangles of each species and level
+        # distances - (L-1,) increasing camera distances where a level ends
+        # hysteresis - Fraction of a distance a tree must pass to change level,
+        #              avoids trees switching back and forth at the boundary
+        # max_triangles - (optional) Maximum number of triangles drawn, the
+        #                 farthest trees are drawn coarser to respect it
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.species = np.asarray(species, dtype=np.int64)
+        self.triangles = np.asarray(triangles, dtype=np.int64)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        assert(len(self.distances) == self.triangles.shape[1] - 1)
+        self.hysteresis = hysteresis
+        self.max_triangles = max_triangles
+        # No level is chosen before the first update, so every tree changes
+        self.levels = np.full(len(self.positions), -1)
+
+    def update(self, view_pos):
+        # Method to choose the level of each tree from the camera position
+        # view_pos - Camera position
+        # return - Indices of the trees whose level changed
+        distance = np.linalg.norm(self.positions - view_pos, axis=1)
+        # Trees keep their level while inside the hysteresis band
+        finest = np.searchsorted(self.distances*(1 + self.hysteresis), distance)
+        coarsest = np.searchsorted(self.distances*(1 - self.hysteresis), distance)
+        levels = np.clip(self.levels, finest, coarsest)
+        if self.max_triangles is not None:
+            levels = self._fit_budget(levels, distance)
+        changed = np.flatnonzero(levels != self.levels)
+        self.levels = levels
+        return changed
+
+    def _fit_budget(self, levels, distance):
+        # Method to draw the farthest trees at the coarsest level until the
+        # forest fits in the triangle budget
+        # levels - (N,) array of chosen levels
+        # distance - (N,) array of camera distances
+        # return - (N,) array of levels
+        drawn = self.triangles[self.species, levels]
+        total = np.sum(drawn)
+        if total <= self.max_triangles:
+            return levels
+        coarse = self.triangles.shape[1] - 1
+        order = np.argsort(-distance)
+        # Triangles left after coarsening each prefix of the farthest trees
+        remaining = total - np.cumsum(drawn[order] - self.triangles[self.species[order], coarse])
+        count = np.count_nonzero(remaining > self.max_triangles)
+        levels = levels.copy()
+        levels[order[:count+1]] = coarse
+        return levels
+
+    def triangle_count(self):
+        # return - Number of triangles of the chosen levels
+        return int(np.sum(self.triangles[self.species, self.levels]))
@@ -1,6 +1,10 @@
 import argparse
 import json
+import os
+import queue
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -14,7 +18,12 @@ import basic_shapes as bs
 import easy_shaders as es
 import lighting_shaders as ls
 
+import aquarium_shaders as aqs
 import fish_model as fm
+import fish_swim as fs
+import temperature_field as tf
+import video_export as ve
+import voxel_lod as vl
 
 h=0.04
 
@@ -25,6 +34,15 @@ ARROW UP/DOWN: move camera up or down
 ARROW LEFT/RIGHT: move camera left or right
 W: zoom in
 S: Zoom out
+A/B/C: toggle fish A/B/C volume
+G: toggle GPU temperature classification
+1/2/3: select fish A/B/C temperature
++/-: raise or lower the selected temperature (GPU classification)
+L: toggle level of detail for fish volumes
+V: toggle volume rendering of the temperature field
+[/]: lower or raise the minimum visible temperature (volume rendering)
+X/Y/Z: toggle and select the slicing plane normal to that axis
+,/.: move the selected slicing plane
 """
 
 # A class to store the application control
@@ -41,6 +59,18 @@ class Controller:
         self.showVolumeA = False
         self.showVolumeB = False
         self.showVolumeC = False
+        self.gpuClassify = False
+        # Preferred temperatures of fish A, B and C
+        self.temperatures = [0.0, 0.0, 0.0]
+        self.selectedFish = 0
+        self.rayMarch = False
+        self.lodVolumes = False
+        # Slicing planes normal to x, y and z
+        self.showSlices = [False, False, False]
+        self.selectedSlice = 0
+        self.sliceStep = 0
+        # Temperatures shown by the volume rendering
+        self.visibleRange = [0.0, 0.0]
 
 
 # we will use the global controller as communication with the callback function
@@ -70,6 +100,41 @@ def on_key(window, key, scancode, action, mods):
     elif key == glfw.KEY_C:
         if action == glfw.PRESS:
             controller.showVolumeC = not controller.showVolumeC
+    elif key == glfw.KEY_G:
+        if action == glfw.PRESS:
+            controller.gpuClassify = not controller.gpuClassify
+    elif key == glfw.KEY_L:
+        if action == glfw.PRESS:
+            controller.lodVolumes = not controller.lodVolumes
+    elif key in (glfw.KEY_X, glfw.KEY_Y, glfw.KEY_Z):
+        if action == glfw.PRESS:
+            axis = [glfw.KEY_X, glfw.KEY_Y, glfw.KEY_Z].index(key)
+            controller.showSlices[axis] = not controller.showSlices[axis]
+            controller.selectedSlice = axis
+    elif key == glfw.KEY_COMMA:
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.sliceStep -= 1
+    elif key == glfw.KEY_PERIOD:
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.sliceStep += 1
+    elif key == glfw.KEY_V:
+        if action == glfw.PRESS:
+            controller.rayMarch = not controller.rayMarch
+    elif key == glfw.KEY_LEFT_BRACKET:
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.visibleRange[0] -= 0.5
+    elif key == glfw.KEY_RIGHT_BRACKET:
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.visibleRange[0] = min(controller.visibleRange[0] + 0.5, controller.visibleRange[1])
+    elif key in (glfw.KEY_1, glfw.KEY_2, glfw.KEY_3):
+        if action == glfw.PRESS:
+            controller.selectedFish = key - glfw.KEY_1
+    elif key in (glfw.KEY_EQUAL, glfw.KEY_KP_ADD):
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.temperatures[controller.selectedFish] += 0.5
+    elif key in (glfw.KEY_MINUS, glfw.KEY_KP_SUBTRACT):
+        if action == glfw.PRESS or action == glfw.REPEAT:
+            controller.temperatures[controller.selectedFish] -= 0.5
     
     elif key == glfw.KEY_SPACE:
         if action == glfw.PRESS:
@@ -94,10 +159,8 @@ class VoxelVolume(object):
         self.r = color[0]
         self.g = color[1]
         self.b = color[2]
-        self.vertices = []
-        self.indices = []
         self.vox_count = 0
-        self.volume_samples = []
+        self.volume_samples = np.zeros((0,3))
 
     def _get_voxel(self, x, y, z):
         # Method to calculate voxel vertices and indices
@@ -154,59 +217,264 @@ class VoxelVolume(object):
             20,21,22,22,23,20]) # Y-
         return vertices, indices
 
-    def add_voxel(self, x,y,z):
-        # Method to add a voxel to the volume
-        # x,y,z - Position of the voxel
-        self.volume_samples.append((x,y,z))
-        vox_vert, vox_ind = self._get_voxel(x,y,z)
-        self.vertices.extend(vox_vert)
-        self.indices.extend((vox_ind + 24*self.vox_count).tolist())
-        self.vox_count +=1
+    def add_voxels(self, points):
+        # Method to add many voxels to the volume
+        # points - (N,3) array of voxel positions
+        self.volume_samples = np.concatenate((self.volume_samples, points))
+        self.vox_count = len(self.volume_samples)
 
     def to_shape(self):
         # Method to return volume as Shape
+        # Voxel geometry is only built here, so it can be deferred
+        # until the volume is shown
         # return - Shape of the voxel volume
-        return bs.Shape(self.vertices, self.indices)
-
-    def get_samples(self, n):
-        # Method to get sample points from the voxel volume
-        # n - Number of samples
-        # return - List of points
-        sample_i = np.random.choice(len(self.volume_samples),n, replace=False)
-        points = [self.volume_samples[i] for i in sample_i]
-        return points
-
-        
-
-
-def find_voxel_volumes(space, Ta,Tb,Tc, voxel_a_color, voxel_b_color, voxel_c_color):
-    # Function to find the vvoxel volumes preferred by the three fish
-    # Ta, Tb, Tc - Temperature preferred by fish A, B and C
-    # voxel_a_color - Color of the fish A region
-    # voxel_b_color - Color of the fish B region
-    # voxel_c_color - Color of the fish c region
+        vertices = []
+        indices = []
+        for i in range(self.vox_count):
+            vox_vert, vox_ind = self._get_voxel(*self.volume_samples[i])
+            vertices.extend(vox_vert)
+            indices.extend((vox_ind + 24*i).tolist())
+        return bs.Shape(vertices, indices)
+
+def find_slab_voxel_volume(space, j0, j1, T, voxel_color):
+    # Function to find the part of a fish volume inside a slab of the aquarium
+    # space - Aquarium temperature volume, may be memory mapped
+    # j0, j1 - The slab holds the cells j0 <= j < j1 along the lenght axis
+    # T - Temperature preferred by the fish
+    # voxel_color - Color of the fish region
+    # return - VoxelVolume of the fish region inside the slab
     global h
-    volumeA = VoxelVolume(voxel_size=h, color=voxAcolor)
-    volumeB = VoxelVolume(voxel_size=h, color=voxBcolor)
-    volumeC = VoxelVolume(voxel_size=h, color=voxCcolor)
-    ta_1, ta_2 = Ta-2, Ta+2
-    tb_1, tb_2 = Tb-2, Tb+2
-    tc_1, tc_2 = Tc-2, Tc+2
-    # Search for adequate temperature in the water
-    for i in range(1, space.shape[0]-1):
-        for j in range(1, space.shape[1]-1):
-            for k in range(1, space.shape[2]-1):
-                # Find fish A area
-                if ta_1 <= space[i,j,k] <= ta_2:
-                    volumeA.add_voxel(i*h, j*h, k*h)
-                # Find fish B area
-                if tb_1 <= space[i,j,k] <= tb_2:
-                    volumeB.add_voxel(i*h, j*h, k*h)
-                # Find fish C area
-                if tc_1 <= space[i,j,k] <= tc_2:
-                    volumeC.add_voxel(i*h, j*h, k*h)
-
-    return volumeA, volumeB, volumeC
+    volume = VoxelVolume(voxel_size=h, color=voxel_color)
+    # Only the slab is read from the file
+    slab = np.asarray(space[1:-1, j0:j1, 1:-1])
+    cells = np.argwhere((T-2 <= slab) & (slab <= T+2)) + (1, j0, 1)
+    volume.add_voxels(cells*h)
+    return volume
+
+# A class to build voxel volumes slab by slab when they are first shown
+# and keep their GPU shapes cached
+class VolumeCache(object):
+    def __init__(self, space, temperatures, colors, max_bytes, slab_size=8, max_uploads=4):
+        # space - Aquarium temperature volume, may be memory mapped
+        # temperatures - Dict of name -> temperature preferred by the fish
+        # colors - Dict of name -> (r,g,b) color of the volume
+        # max_bytes - GPU memory budget for the cached volumes
+        # slab_size - Number of cells along the lenght axis meshed together
+        # max_uploads - Maximum number of slabs uploaded in a frame
+        self.space = space
+        self.temperatures = temperatures
+        self.colors = colors
+        self.max_bytes = max_bytes
+        self.slab_size = slab_size
+        self.max_uploads = max_uploads
+        self.used_bytes = 0
+        # Volume meshes are built in a background thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.slabs = queue.Queue()
+        self.streaming = set()
+        # Least recently used volumes first, name -> [node, size]
+        self.nodes = OrderedDict()
+
+    def _stream(self, name):
+        # Method to mesh a volume slab by slab, runs in the background thread
+        # name - Name of the volume
+        for j0 in range(1, self.space.shape[1]-1, self.slab_size):
+            j1 = min(j0 + self.slab_size, self.space.shape[1]-1)
+            volume = find_slab_voxel_volume(self.space, j0, j1,
+                self.temperatures[name], self.colors[name])
+            if volume.vox_count > 0:
+                self.slabs.put((name, volume.to_shape()))
+        # Mark the end of the volume
+        self.slabs.put((name, None))
+
+    def get_node(self, name):
+        # Method to get the scene node of a volume
+        # The volume starts streaming the first time it is asked
+        # name - Name of the volume
+        # return - SceneGraphNode of the volume, with the slabs uploaded so far
+        if name not in self.nodes:
+            self.nodes[name] = [sg.SceneGraphNode(name), 0]
+            self.streaming.add(name)
+            self.executor.submit(self._stream, name)
+        self.nodes.move_to_end(name)
+        return self.nodes[name][0]
+
+    def update(self, visible):
+        # Method to upload finished slabs and free GPU memory
+        # Must be called from the thread that owns the OpenGL context
+        # visible - Names of the volumes being shown
+        for _ in range(self.max_uploads):
+            try:
+                name, shape = self.slabs.get_nowait()
+            except queue.Empty:
+                break
+            if shape is None:
+                self.streaming.discard(name)
+                continue
+            slab = sg.SceneGraphNode(name + "_slab")
+            slab.childs = [es.toGPUShape(shape)]
+            size = (len(shape.vertices) + len(shape.indices))*es.SIZE_IN_BYTES
+            self.nodes[name][0].childs.append(slab)
+            self.nodes[name][1] += size
+            self.used_bytes += size
+        # Free hidden volumes while over the memory budget
+        for name in list(self.nodes.keys()):
+            if self.used_bytes <= self.max_bytes:
+                break
+            if name not in visible and name not in self.streaming:
+                self.free(name)
+
+    def free(self, name):
+        # Method to free the GPU buffers of a volume
+        # name - Name of the volume
+        node, size = self.nodes.pop(name)
+        for slab in node.childs:
+            gpuShape = slab.childs[0]
+            glDeleteBuffers(2, [gpuShape.vbo, gpuShape.ebo])
+            glDeleteVertexArrays(1, [gpuShape.vao])
+        self.used_bytes -= size
+
+# A class to draw a voxel volume with a level of detail chosen from the camera
+class LODVolume(object):
+    def __init__(self, pyramid, color):
+        # pyramid - OccupancyPyramid of the volume cells
+        # color - (r,g,b) color of the voxels
+        self.pyramid = pyramid
+        self.color = color
+        self.vbo = glGenBuffers(1)
+        self.size = 0
+        self.view_pos = None
+
+    def update(self, view_pos, pixel_scale):
+        # Method to select the voxels to draw, only done when the camera moves
+        # view_pos - Camera position in the volume coordinates
+        # pixel_scale - Screen height / (2*tan(fovy/2))
+        if self.view_pos is not None and np.allclose(view_pos, self.view_pos):
+            return
+        self.view_pos = view_pos
+        selected = self.pyramid.select(view_pos, pixel_scale)
+        instances = [np.column_stack((centers, np.full(len(centers), size)))
+                     for centers, size in selected]
+        instances = np.concatenate(instances + [np.zeros((0,4))]).astype(np.float32)
+        self.size = len(instances)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, instances.nbytes, instances, GL_DYNAMIC_DRAW)
+
+    def draw(self, pipeline, gpuVoxel):
+        # Method to draw the selected voxels
+        # pipeline - InstancedVoxelShaderProgram in use
+        # gpuVoxel - GPUShape of a unit cube with normals
+        if self.size == 0:
+            return
+        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "color"), *self.color)
+        pipeline.drawShape(gpuVoxel, self.vbo, self.size)
+
+def prepare_field(space, fish):
+    # Function to build everything that needs the whole temperature field,
+    # runs in the background so the render loop does not stall
+    # space - Aquarium temperature volume, may be memory mapped
+    # fish - List of (temperature, number of fish) of each species
+    # return - TemperatureIndex and, for each species, the OccupancyPyramid of
+    #          its preferred cells, the fish spawn positions and SchoolSimulation
+    global h
+    index = tf.TemperatureIndex(space)
+    species = []
+    for t, n in fish:
+        cells = index.query(t-2, t+2)
+        # Fish spawn and swim inside the cells of their preferred temperature
+        inside = np.zeros(index.shape, dtype=bool)
+        inside.flat[cells] = True
+        samples = index.positions(index.sample(t-2, t+2, n), h)
+        species.append((vl.OccupancyPyramid(inside, h), samples,
+                        fs.SchoolSimulation(samples, inside, h)))
+    return index, species
+
+def stream_volume_texture(space, slabs):
+    # Function to read the temperature texture slabs, runs in the background
+    # space - Aquarium temperature volume, may be memory mapped
+    # slabs - Queue where the slabs are put, None marks the end
+    for slab in aqs.volumeTextureSlabs(space):
+        slabs.put(slab)
+    slabs.put(None)
+
+# A class to show an axis aligned slice of the temperature field
+class SlicePlane(object):
+    def __init__(self, space, axis, executor):
+        # space - Aquarium temperature volume, may be memory mapped
+        # axis - Axis normal to the plane
+        # executor - Executor where slices are read
+        self.space = space
+        self.axis = axis
+        self.executor = executor
+        self.position = space.shape[axis]//2
+        dims = [space.shape[a] for a in range(3) if a != axis]
+        self.stream = aqs.SliceStream(*dims)
+        self.future = None
+        self.loaded = None
+
+    def move(self, step):
+        # Method to move the plane
+        # step - Number of cells to move
+        self.position = int(np.clip(self.position + step, 0, self.space.shape[self.axis]-1))
+
+    def _read(self, position):
+        # Method to read a slice, runs in the executor
+        # position - Index of the slice along the axis
+        # return - position and (n,m) slice
+        index = [slice(None)]*3
+        index[self.axis] = position
+        return position, np.array(self.space[tuple(index)], dtype=np.float32)
+
+    def update(self):
+        # Method to upload the last slice read and ask for the current one
+        # Only one slice is read at a time, so fast scrubbing skips slices
+        if self.future is not None and self.future.done():
+            self.loaded, data = self.future.result()
+            self.future = None
+            self.stream.upload(data)
+        if self.future is None and self.loaded != self.position:
+            self.future = self.executor.submit(self._read, self.position)
+
+    def transform(self):
+        # Method to get the transform of the unit quad to the plane
+        # return - (4,4) matrix in the volume coordinates
+        global h
+        u, v = [a for a in range(3) if a != self.axis]
+        # Quad x and y go along the plane axes u and v, quad z along the normal
+        M = np.zeros((4,4), dtype=np.float32)
+        M[u,0] = (self.space.shape[u]-1)*h
+        M[v,1] = (self.space.shape[v]-1)*h
+        M[self.axis,2] = 1
+        M[self.axis,3] = self.position*h
+        M[3,3] = 1
+        return M
+
+def setPhongUniforms(pipeline, viewPos, projection, view):
+    # Function to set the lighting and camera uniforms of a phong pipeline
+    # pipeline - Shader program in use
+    # viewPos - Camera position
+    # projection, view - Projection and view matrices
+
+    # White light in all components: ambient, diffuse and specular.
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "La"), 1.0, 1.0, 1.0)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ld"), 1.0, 1.0, 1.0)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ls"), 1.0, 1.0, 1.0)
+
+    # Object is barely visible at only ambient. Diffuse behavior is slightly red. Sparkles are white
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ka"), 0.3, 0.3, 0.3)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Kd"), 0.9, 0.9, 0.9)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "Ks"), 1., 1., 1.)
+
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "lightPosition"), -5, -5, 5)
+    glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
+    glUniform1ui(glGetUniformLocation(pipeline.shaderProgram, "shininess"), 100)
+    
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "constantAttenuation"), 0.0001)
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "linearAttenuation"), 0.03)
+    glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "quadraticAttenuation"), 0.01)
+
+    glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+    glUniformMatrix4fv(glGetUniformLocation(pipeline.shaderProgram, "view"), 1, GL_TRUE, view)
 
 def createAquarium(width, lenght, height, r,g,b):
     # Function to create the aquarium bounding box as lines
@@ -260,6 +528,15 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Aquarium View.')
     parser.add_argument('filename', metavar='Setup_File', type=str,
                     help='(string) Name of the view setup file')
+    parser.add_argument('--export', metavar='Output', type=str, default=None,
+                    help='(string) Render a camera orbit offscreen into a video file, '
+                         'or into a PNG sequence if it has no extension')
+    parser.add_argument('--frames', metavar='Frames', type=int, default=300,
+                    help='(int) Number of frames to export')
+    parser.add_argument('--fps', metavar='FPS', type=int, default=30,
+                    help='(int) Frames per second of the exported video')
+    parser.add_argument('--volumes', metavar='Volumes', type=str, default="",
+                    help='(string) Fish volumes shown at start, e.g. AC')
     args = parser.parse_args()
     """ Load json parameters
         filename: File to read aquarium temperature
@@ -269,18 +546,13 @@ if __name__ == "__main__":
         n_a :     Number of type A fish
         n_b :     Number of type B fish
         n_c :     Number of type C fish
+        volume_cache_mb : (optional) GPU memory budget for the fish volumes
 
     """
     with open(args.filename, 'r') as setup_file:
         config = json.load(setup_file)
     print(config)
 
-    # Load aquarium solution
-    aq_space = np.load(config["filename"])
-    aq_width  = (aq_space.shape[0]-1) * h
-    aq_lenght = (aq_space.shape[1]-1) * h
-    aq_height = (aq_space.shape[2]-1) * h
-
     # Initialize glfw
     if not glfw.init():
         sys.exit()
@@ -288,6 +560,10 @@ if __name__ == "__main__":
     width = 600
     height = 600
 
+    # Exported frames are rendered offscreen
+    if args.export:
+        glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+
     window = glfw.create_window(width, height, "Forest Generator", None, None)
 
     if not window:
@@ -301,6 +577,26 @@ if __name__ == "__main__":
     # Connecting the callback function 'on_key' to handle keyboard events
     glfw.set_key_callback(window, on_key)
 
+    # Load aquarium solution, values are read from the file when needed
+    aq_space = np.load(config["filename"], mmap_mode='r')
+    aq_width  = (aq_space.shape[0]-1) * h
+    aq_lenght = (aq_space.shape[1]-1) * h
+    aq_height = (aq_space.shape[2]-1) * h
+
+    # Temperature range queries are answered from an index built once,
+    # in the background so the window is usable right away. The fish
+    # volumes and simulations are built with it
+    field_executor = ThreadPoolExecutor(max_workers=2)
+    field_future = field_executor.submit(prepare_field, aq_space,
+        [(config['t_a'], config['n_a']), (config['t_b'], config['n_b']), (config['t_c'], config['n_c'])])
+    aq_index = None
+
+    # Temperature volume for GPU classification, uploaded slab by slab
+    gpuTemperature = aqs.VolumeTexture(aq_space.shape, GL_LINEAR)
+    temperature_slabs = queue.Queue()
+    field_executor.submit(stream_volume_texture, aq_space, temperature_slabs)
+    temperature_ready = False
+
     # Assembling the shader program (pipeline) with both shaders
     mvpPipeline = es.SimpleModelViewProjectionShaderProgram()
     phongPipeline = ls.SimplePhongShaderProgram()
@@ -319,21 +615,36 @@ if __name__ == "__main__":
     voxBcolor = (0.407,0.298,0.921)
     voxCcolor = (0.768,0.372,0.337)
 
-    fish_volumes = find_voxel_volumes(aq_space, config['t_a'],config['t_b'],config['t_c'],voxAcolor, voxBcolor, voxCcolor)
-
-    
-    volumeA_scene = sg.SceneGraphNode("Fish_A_volume")
-    vol_a_shape = fish_volumes[0].to_shape()
-    volumeA_scene.childs = [es.toGPUShape(vol_a_shape)]
-
-    volumeB_scene = sg.SceneGraphNode("Fish_B_volume")
-    vol_b_shape = fish_volumes[1].to_shape()
-    volumeB_scene.childs = [es.toGPUShape(vol_b_shape)]
-
-    volumeC_scene = sg.SceneGraphNode("Fish_C_volume")
-    vol_c_shape = fish_volumes[2].to_shape()
-    volumeC_scene.childs = [es.toGPUShape(vol_c_shape)]
-
+    # Volume meshes are streamed slab by slab the first time they are shown
+    volume_cache = VolumeCache(aq_space,
+        {"Fish_A_volume": config['t_a'],
+         "Fish_B_volume": config['t_b'],
+         "Fish_C_volume": config['t_c']},
+        {"Fish_A_volume": voxAcolor,
+         "Fish_B_volume": voxBcolor,
+         "Fish_C_volume": voxCcolor},
+        max_bytes=config.get("volume_cache_mb", 256)*2**20)
+
+    # GPU classification of the temperature volume
+    controller.temperatures = [config['t_a'], config['t_b'], config['t_c']]
+    gpuVoxel = es.toGPUShape(aqs.createNormalsCube())
+    classifyPipeline = aqs.VoxelClassifyShaderProgram()
+
+    # Volume rendering of the temperature field
+    # Colder water is more transparent
+    tf_colors = plt.get_cmap("coolwarm")(np.linspace(0, 1, 256))
+    tf_colors[:,3] = np.linspace(0.05, 1, 256)
+    gpuTransfer = aqs.toGPUTransferFunction(tf_colors)
+    rayMarchPipeline = aqs.RayMarchingShaderProgram()
+
+    # Slicing planes, slices are read from the file in the background
+    slicePipeline = aqs.SliceShaderProgram()
+    gpuSliceQuad = es.toGPUShape(aqs.createSliceQuad())
+    slice_executor = ThreadPoolExecutor(max_workers=1)
+    slice_planes = [SlicePlane(aq_space, axis, slice_executor) for axis in range(3)]
+
+    # Voxel pyramids to draw large volumes with bounded cost
+    lodPipeline = aqs.InstancedVoxelShaderProgram()
 
     # Create aquarium
     gpuAq = es.toGPUShape(createAquarium(aq_width, aq_lenght, aq_height,0,0,0))
@@ -355,41 +666,85 @@ if __name__ == "__main__":
     gpubodyC = es.toGPUShape(bodyC)
     gpuFinC = es.toGPUShape(finC)
 
-    fish = []
-    # Add type A fish
-    samples = fish_volumes[0].get_samples(config['n_a'])
-    for p in samples:
-        pos = tr.matmul([tr.translate(*p),tr.rotationZ(2*np.pi*np.random.random())])
-        fish.append(fm.Fish(3, gpubodyA, gpuFinA, finbodytrA, pos))
-    # Add type B fish
-    samples = fish_volumes[1].get_samples(config['n_b'])
-    for p in samples:
-        pos = tr.matmul([tr.translate(*p),tr.rotationZ(2*np.pi*np.random.random())])
-        fish.append(fm.Fish(6, gpubodyB, gpuFinB, finbodytrB, pos))
-    # Add type C fish
-    samples = fish_volumes[2].get_samples(config['n_c'])
-    for p in samples:
-        pos = tr.matmul([tr.translate(*p),tr.rotationZ(2*np.pi*np.random.random())])
-        fish.append(fm.Fish(1.8, gpubodyC, gpuFinC, finbodytrC, pos))
-
-    fish_scene = sg.SceneGraphNode("aquarium_fish")
-    fish_scene.childs = [f.fishScene for f in fish]
-    fish_scene.transform = tr.translate(-aq_width/2, -aq_lenght/2, -aq_height/2)
+    # Fish of each species are drawn with instancing
+    schoolPipeline = aqs.FishSchoolShaderProgram()
+    schools = []
+    simulations = []
+    fish_transform = tr.translate(-aq_width/2, -aq_lenght/2, -aq_height/2)
 
     # Using the same view and projection matrices in the whole application
     projection = tr.perspective(45, float(width)/float(height), 0.1, 100)
+    # Pixels covered by an object of unit size at unit distance
+    pixel_scale = height/(2*np.tan(np.deg2rad(45)/2))
     
     camera_theta = 0.0
     camera_phi = np.pi/4
     camera_r = 3
     ltime = 0
+
+    controller.showVolumeA = 'A' in args.volumes.upper()
+    controller.showVolumeB = 'B' in args.volumes.upper()
+    controller.showVolumeC = 'C' in args.volumes.upper()
+
+    if args.export:
+        framebuffer = ve.Framebuffer(width, height)
+        frame_reader = ve.FrameReader(width, height)
+        if os.path.splitext(args.export)[1]:
+            frame_writer = ve.EncoderWriter(args.export, width, height, args.fps)
+        else:
+            frame_writer = ve.PNGWriter(args.export)
+        frame = 0
+        export_start = None
     
     while not glfw.window_should_close(window):
         # Using GLFW to check for input events
         glfw.poll_events()
         time = glfw.get_time()
+        if args.export:
+            # Scripted camera orbit with a fixed time step
+            time = frame/args.fps
+            camera_theta = 2*np.pi*frame/args.frames
+
+        # Finish the setup once the field is ready, only GPU objects are created here
+        if aq_index is None and field_future.done():
+            aq_index, species = field_future.result()
+
+            # Bricks for the volume rendering empty space skipping, a small table
+            brick_size = aq_index.brick_size
+            gpuBricks = aqs.toGPUBrickTexture(aq_index.bricks)
+            t_min = float(aq_index.bricks[...,0].min())
+            t_max = float(aq_index.bricks[...,1].max())
+            controller.visibleRange = [t_min, t_max]
+
+            lod_volumes = {}
+            for name, color, rotFrec, gpuBody, gpuFin, finBodyTR, (pyramid, samples, simulation) in zip(
+                    ["Fish_A_volume", "Fish_B_volume", "Fish_C_volume"],
+                    [voxAcolor, voxBcolor, voxCcolor], [3, 6, 1.8],
+                    [gpubodyA, gpubodyB, gpubodyC], [gpuFinA, gpuFinB, gpuFinC],
+                    [finbodytrA, finbodytrB, finbodytrC], species):
+                lod_volumes[name] = LODVolume(pyramid, color)
+                simulations.append(simulation)
+                schools.append(fm.FishSchool(gpuBody, gpuFin, finBodyTR, samples, simulation.headings(), rotFrec))
+
+        # Upload a few temperature slabs per frame
+        for _ in range(4):
+            if temperature_ready:
+                break
+            try:
+                slab = temperature_slabs.get_nowait()
+            except queue.Empty:
+                break
+            if slab is None:
+                temperature_ready = True
+            else:
+                gpuTemperature.upload(*slab)
         dt = time-ltime
         ltime = time
+
+        # Long frames are simulated as a short step so fish do not jump
+        for simulation, school in zip(simulations, schools):
+            simulation.step(min(dt, 1/30))
+            school.set_positions(simulation.fish_positions(), simulation.headings())
         camera_theta -= 2.0*dt*(controller.right - controller.left)
         camera_phi -= 2.0*dt*(controller.up - controller.down)
         camera_phi = np.clip(camera_phi, 0+0.00001, np.pi-0.00001) # view matrix is NaN when phi=0
@@ -408,6 +763,9 @@ if __name__ == "__main__":
             np.array([0,0,1])
         )
 
+        if args.export:
+            framebuffer.bind()
+
         # Clearing the screen in both, color and depth
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
@@ -425,41 +783,118 @@ if __name__ == "__main__":
         if controller.showAxis:
             mvpPipeline.drawShape(gpuAxis, GL_LINES)
         # Draw fish
-        for f in fish:
-            f.update(time)
-        sg.drawSceneGraphNode(fish_scene, mvpPipeline,"model")
+        glUseProgram(schoolPipeline.shaderProgram)
+        glUniformMatrix4fv(glGetUniformLocation(schoolPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+        glUniformMatrix4fv(glGetUniformLocation(schoolPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+        glUniformMatrix4fv(glGetUniformLocation(schoolPipeline.shaderProgram, "model"), 1, GL_TRUE, fish_transform)
+        for school in schools:
+            school.draw(schoolPipeline, time)
 
         # Draw aquarium
         glUseProgram(phongPipeline.shaderProgram)
 
-        # White light in all components: ambient, diffuse and specular.
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "La"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ld"), 1.0, 1.0, 1.0)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ls"), 1.0, 1.0, 1.0)
-
-        # Object is barely visible at only ambient. Diffuse behavior is slightly red. Sparkles are white
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ka"), 0.3, 0.3, 0.3)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Kd"), 0.9, 0.9, 0.9)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "Ks"), 1., 1., 1.)
-
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "lightPosition"), -5, -5, 5)
-        glUniform3f(glGetUniformLocation(phongPipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
-        glUniform1ui(glGetUniformLocation(phongPipeline.shaderProgram, "shininess"), 100)
-        
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "constantAttenuation"), 0.0001)
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "linearAttenuation"), 0.03)
-        glUniform1f(glGetUniformLocation(phongPipeline.shaderProgram, "quadraticAttenuation"), 0.01)
-
-        glUniformMatrix4fv(glGetUniformLocation(phongPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
-        glUniformMatrix4fv(glGetUniformLocation(phongPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
-        
+        setPhongUniforms(phongPipeline, viewPos, projection, view)
+
         # Volume to show
-        scene.childs =  [volumeA_scene]*controller.showVolumeA + \
-                        [volumeB_scene]*controller.showVolumeB + \
-                        [volumeC_scene]*controller.showVolumeC 
+        visible = ["Fish_A_volume"]*controller.showVolumeA + \
+                  ["Fish_B_volume"]*controller.showVolumeB + \
+                  ["Fish_C_volume"]*controller.showVolumeC
+        cpu_volumes = not (controller.gpuClassify or controller.lodVolumes)
+        volume_cache.update(visible if cpu_volumes else [])
+        if not cpu_volumes:
+            scene.childs = []
+        else:
+            scene.childs = [volume_cache.get_node(name) for name in visible]
         sg.drawSceneGraphNode(scene, phongPipeline, "model")
 
+        # Volumes with level of detail, far regions are drawn with coarse voxels
+        if aq_index is not None and controller.lodVolumes and not controller.gpuClassify:
+            glUseProgram(lodPipeline.shaderProgram)
+            setPhongUniforms(lodPipeline, viewPos, projection, view)
+            glUniformMatrix4fv(glGetUniformLocation(lodPipeline.shaderProgram, "model"), 1, GL_TRUE, scene.transform)
+            local_view_pos = viewPos + np.array([aq_width/2, aq_lenght/2, aq_height/2])
+            for name in visible:
+                lod_volumes[name].update(local_view_pos, pixel_scale)
+                lod_volumes[name].draw(lodPipeline, gpuVoxel)
+
+        # Classify the temperature volume in the GPU
+        if aq_index is not None and temperature_ready and controller.gpuClassify:
+            glUseProgram(classifyPipeline.shaderProgram)
+            setPhongUniforms(classifyPipeline, viewPos, projection, view)
+            glUniformMatrix4fv(glGetUniformLocation(classifyPipeline.shaderProgram, "model"), 1, GL_TRUE, scene.transform)
+
+            # Preferred ranges are only uniforms, changing them needs no re-mesh
+            glUniform1f(glGetUniformLocation(classifyPipeline.shaderProgram, "voxelSize"), h)
+            for name, t in zip(["rangeA", "rangeB", "rangeC"], controller.temperatures):
+                glUniform2f(glGetUniformLocation(classifyPipeline.shaderProgram, name), t-2, t+2)
+            for name, color in zip(["colorA", "colorB", "colorC"], [voxAcolor, voxBcolor, voxCcolor]):
+                glUniform3f(glGetUniformLocation(classifyPipeline.shaderProgram, name), *color)
+            glUniform3i(glGetUniformLocation(classifyPipeline.shaderProgram, "showVolumes"),
+                controller.showVolumeA, controller.showVolumeB, controller.showVolumeC)
+            classifyPipeline.drawShape(gpuVoxel, gpuTemperature.texture, aq_space.shape)
+
+        # Slicing planes
+        slice_planes[controller.selectedSlice].move(controller.sliceStep)
+        controller.sliceStep = 0
+        if aq_index is not None and any(controller.showSlices):
+            glUseProgram(slicePipeline.shaderProgram)
+            glUniformMatrix4fv(glGetUniformLocation(slicePipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+            glUniformMatrix4fv(glGetUniformLocation(slicePipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+            glUniform2f(glGetUniformLocation(slicePipeline.shaderProgram, "temperatureRange"), t_min, t_max)
+            for plane, show in zip(slice_planes, controller.showSlices):
+                if not show:
+                    continue
+                plane.update()
+                glUniformMatrix4fv(glGetUniformLocation(slicePipeline.shaderProgram, "model"), 1, GL_TRUE,
+                    np.matmul(scene.transform, plane.transform()))
+                slicePipeline.drawShape(gpuSliceQuad, plane.stream.texture, gpuTransfer)
+
+        # Volume rendering is drawn last as it is transparent
+        if aq_index is not None and temperature_ready and controller.rayMarch:
+            glUseProgram(rayMarchPipeline.shaderProgram)
+            glUniformMatrix4fv(glGetUniformLocation(rayMarchPipeline.shaderProgram, "projection"), 1, GL_TRUE, projection)
+            glUniformMatrix4fv(glGetUniformLocation(rayMarchPipeline.shaderProgram, "view"), 1, GL_TRUE, view)
+            glUniformMatrix4fv(glGetUniformLocation(rayMarchPipeline.shaderProgram, "model"), 1, GL_TRUE,
+                tr.scale(aq_width, aq_lenght, aq_height))
+            glUniform3f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "viewPosition"), viewPos[0], viewPos[1], viewPos[2])
+            glUniform3f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "volumeOrigin"), -aq_width/2, -aq_lenght/2, -aq_height/2)
+            glUniform1f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "voxelSize"), h)
+            glUniform2f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "temperatureRange"), t_min, t_max)
+            glUniform2f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "visibleRange"), *controller.visibleRange)
+            glUniform1f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "brickSize"), brick_size)
+            glUniform1f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "stepSize"), 1.0)
+            glUniform1f(glGetUniformLocation(rayMarchPipeline.shaderProgram, "opacity"), 0.1)
+            rayMarchPipeline.drawShape(gpuVoxel, gpuTemperature.texture, gpuBricks, gpuTransfer)
+
+        if args.export:
+            # Frames are exported once the field and the shown volumes are loaded
+            ready = aq_index is not None and temperature_ready and not volume_cache.streaming and volume_cache.slabs.empty()
+            if ready:
+                if export_start is None:
+                    export_start = glfw.get_time()
+                # The previous frame is written while this one is copied
+                previous = frame_reader.read()
+                if previous is not None:
+                    frame_writer.write(previous)
+                frame += 1
+                if frame == args.frames:
+                    break
+            continue
+
         # Once the render is done, buffers are swapped, showing only the complete scene.
         glfw.swap_buffers(window)
 
+    if args.export:
+        last = frame_reader.flush()
+        if last is not None:
+            frame_writer.write(last)
+        frame_writer.close()
+        if export_start is not None and frame > 0:
+            elapsed = glfw.get_time() - export_start
+            print("Exported {} frames in {:.2f} s ({:.1f} frames per second)".format(
+                frame, elapsed, frame/elapsed))
+
+    volume_cache.executor.shutdown(wait=False)
+    field_executor.shutdown(wait=False)
+    slice_executor.shutdown(wait=False)
     glfw.terminate()
\ No newline at end of file
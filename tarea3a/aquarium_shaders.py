@@ -0,0 +1,767 @@
+# coding=utf-8
+"""
+Shaders for the aquarium temperature field
+"""
+
+from OpenGL.GL import *
+import OpenGL.GL.shaders
+import numpy as np
+
+import basic_shapes as bs
+from easy_shaders import GPUShape
+
+
+# Phong lighting of the interpolated fragment color and normal
+PHONG_FRAGMENT_SHADER = """
+    #version 330 core
+
+    out vec4 fragColor;
+
+    in vec3 fragNormal;
+    in vec3 fragPosition;
+    in vec3 fragOriginalColor;
+
+    uniform vec3 lightPosition;
+    uniform vec3 viewPosition;
+    uniform vec3 La;
+    uniform vec3 Ld;
+    uniform vec3 Ls;
+    uniform vec3 Ka;
+    uniform vec3 Kd;
+    uniform vec3 Ks;
+    uniform uint shininess;
+    uniform float constantAttenuation;
+    uniform float linearAttenuation;
+    uniform float quadraticAttenuation;
+
+    void main()
+    {
+        // ambient
+        vec3 ambient = Ka * La;
+
+        // diffuse
+        vec3 normalizedNormal = normalize(fragNormal);
+        vec3 toLight = lightPosition - fragPosition;
+        vec3 lightDir = normalize(toLight);
+        float diff = max(dot(normalizedNormal, lightDir), 0.0);
+        vec3 diffuse = Kd * Ld * diff;
+
+        // specular
+        vec3 viewDir = normalize(viewPosition - fragPosition);
+        vec3 reflectDir = reflect(-lightDir, normalizedNormal);
+        float spec = pow(max(dot(viewDir, reflectDir), 0.0), shininess);
+        vec3 specular = Ks * Ls * spec;
+
+        // attenuation
+        float distToLight = length(toLight);
+        float attenuation = constantAttenuation
+            + linearAttenuation * distToLight
+            + quadraticAttenuation * distToLight * distToLight;
+
+        vec3 result = (ambient + ((diffuse + specular) / attenuation)) * fragOriginalColor;
+        fragColor = vec4(result, 1.0);
+    }
+    """
+
+
+def volumeTextureSlabs(space, slab_size=8):
+    # Read a scalar volume in slabs ready for VolumeTexture.upload
+    # Slabs are read and transposed where the generator runs, so it may
+    # run in a background thread
+    # space - (nx,ny,nz) array, may be memory mapped
+    # slab_size - Number of cells along x of a slab
+    # yield - First x index and (nz,ny,k) float32 array of each slab
+    for i0 in range(0, space.shape[0], slab_size):
+        slab = np.asarray(space[i0:i0+slab_size])
+        yield i0, np.ascontiguousarray(np.transpose(slab, (2, 1, 0)), dtype=np.float32)
+
+
+# A class to fill a float 3D texture slab by slab
+class VolumeTexture(object):
+    def __init__(self, shape, filterMode=GL_NEAREST):
+        # The upload of a large volume is spread over several frames
+        # shape - (nx,ny,nz) shape of the volume, texel (i,j,k) stores space[i,j,k]
+        # filterMode: GL_LINEAR, GL_NEAREST
+        self.shape = shape
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_3D, self.texture)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, filterMode)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, filterMode)
+        glTexImage3D(GL_TEXTURE_3D, 0, GL_R32F, shape[0], shape[1], shape[2],
+            0, GL_RED, GL_FLOAT, None)
+
+    def upload(self, i0, data):
+        # Method to copy a slab into the texture
+        # i0 - First x index of the slab
+        # data - (nz,ny,k) float32 array, as given by volumeTextureSlabs
+        glBindTexture(GL_TEXTURE_3D, self.texture)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage3D(GL_TEXTURE_3D, 0, i0, 0, 0, data.shape[2], data.shape[1], data.shape[0],
+            GL_RED, GL_FLOAT, data)
+
+
+def toGPUBrickTexture(bricks):
+    # Upload a brick min/max table as a two channel float 3D texture
+    # bricks - (bx,by,bz,2) array from temperature_field.brick_min_max
+    # return - OpenGL texture id
+    texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_3D, texture)
+
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_WRAP_R, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+    glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+
+    data = np.ascontiguousarray(np.transpose(bricks, (2, 1, 0, 3)), dtype=np.float32)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    glTexImage3D(GL_TEXTURE_3D, 0, GL_RG32F, bricks.shape[0], bricks.shape[1], bricks.shape[2],
+        0, GL_RG, GL_FLOAT, data)
+
+    return texture
+
+
+def toGPUTransferFunction(colors):
+    # Upload a transfer function as a 1D RGBA texture
+    # colors - (n,4) array of rgba values in [0,1], from the lowest
+    #          to the highest temperature
+    # return - OpenGL texture id
+    texture = glGenTextures(1)
+    glBindTexture(GL_TEXTURE_1D, texture)
+
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_1D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+
+    data = np.ascontiguousarray(colors, dtype=np.float32)
+    glTexImage1D(GL_TEXTURE_1D, 0, GL_RGBA32F, len(colors), 0, GL_RGBA, GL_FLOAT, data)
+
+    return texture
+
+
+def createSliceQuad():
+    # A unit quad in the xy plane with corners (0,0) and (1,1)
+    # return - Shape with 3d positions and 2d texture coordinates
+    vertices = [
+    #   positions        texture
+        0.0, 0.0, 0.0,   0.0, 0.0,
+        1.0, 0.0, 0.0,   1.0, 0.0,
+        1.0, 1.0, 0.0,   1.0, 1.0,
+        0.0, 1.0, 0.0,   0.0, 1.0]
+
+    # Both sides are drawn, so no face culling is needed
+    indices = [
+        0, 1, 2,
+        2, 3, 0]
+
+    return bs.Shape(vertices, indices)
+
+
+# A class to stream 2D slices of a volume into a float texture
+class SliceStream(object):
+    def __init__(self, width, height):
+        # width, height - Dimensions of the slices
+        self.width = width
+        self.height = height
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_R32F, width, height, 0, GL_RED, GL_FLOAT, None)
+
+        # Two pixel buffers are used in turns, so a new slice can be
+        # written while the previous one is still being copied
+        self.pbos = glGenBuffers(2)
+        self.nbytes = width*height*4
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, self.nbytes, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.next_pbo = 0
+
+    def upload(self, data):
+        # Method to replace the slice shown by the texture
+        # data - (width,height) array, texel (u,v) stores data[u,v]
+        # OpenGL expects the first index to change fastest
+        data = np.ascontiguousarray(np.transpose(data), dtype=np.float32)
+        pbo = self.pbos[self.next_pbo]
+        self.next_pbo = 1 - self.next_pbo
+
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo)
+        # Orphan the old storage so the write does not wait for the GPU
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, self.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_PIXEL_UNPACK_BUFFER, 0, self.nbytes, data)
+
+        # The copy to the texture reads from the bound pixel buffer
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.width, self.height,
+            GL_RED, GL_FLOAT, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+
+def createNormalsCube():
+    # A unit cube centered in the origin with normals and without color
+    # return - Shape with 3d positions and 3d normals
+    vertices = [
+    #   positions         normals
+    # Z+
+        -0.5, -0.5,  0.5, 0,0,1,
+         0.5, -0.5,  0.5, 0,0,1,
+         0.5,  0.5,  0.5, 0,0,1,
+        -0.5,  0.5,  0.5, 0,0,1,
+
+    # Z-
+        -0.5, -0.5, -0.5, 0,0,-1,
+         0.5, -0.5, -0.5, 0,0,-1,
+         0.5,  0.5, -0.5, 0,0,-1,
+        -0.5,  0.5, -0.5, 0,0,-1,
+
+    # X+
+         0.5, -0.5, -0.5, 1,0,0,
+         0.5,  0.5, -0.5, 1,0,0,
+         0.5,  0.5,  0.5, 1,0,0,
+         0.5, -0.5,  0.5, 1,0,0,
+
+    # X-
+        -0.5, -0.5, -0.5, -1,0,0,
+        -0.5,  0.5, -0.5, -1,0,0,
+        -0.5,  0.5,  0.5, -1,0,0,
+        -0.5, -0.5,  0.5, -1,0,0,
+
+    # Y+
+        -0.5,  0.5, -0.5, 0,1,0,
+         0.5,  0.5, -0.5, 0,1,0,
+         0.5,  0.5,  0.5, 0,1,0,
+        -0.5,  0.5,  0.5, 0,1,0,
+
+    # Y-
+        -0.5, -0.5, -0.5, 0,-1,0,
+         0.5, -0.5, -0.5, 0,-1,0,
+         0.5, -0.5,  0.5, 0,-1,0,
+        -0.5, -0.5,  0.5, 0,-1,0
+        ]
+
+    # Defining connections among vertices
+    # We have a triangle every 3 indices specified
+    indices = [
+         0, 1, 2, 2, 3, 0, # Z+
+         7, 6, 5, 5, 4, 7, # Z-
+         8, 9,10,10,11, 8, # X+
+        15,14,13,13,12,15, # X-
+        19,18,17,17,16,19, # Y+
+        20,21,22,22,23,20] # Y-
+
+    return bs.Shape(vertices, indices)
+
+
+class VoxelClassifyShaderProgram:
+    # Draws one instanced cube per inner voxel of a temperature 3D texture.
+    # Voxels outside every enabled temperature range are moved out of the
+    # clip volume, so changing a range is only a uniform update.
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+            layout (location = 1) in vec3 normal;
+
+            out vec3 fragPosition;
+            out vec3 fragOriginalColor;
+            out vec3 fragNormal;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+
+            uniform sampler3D temperature;
+            uniform float voxelSize;
+            // Temperature ranges (min, max) and colors of each fish
+            uniform vec2 rangeA;
+            uniform vec2 rangeB;
+            uniform vec2 rangeC;
+            uniform vec3 colorA;
+            uniform vec3 colorB;
+            uniform vec3 colorC;
+            // Which ranges are shown
+            uniform ivec3 showVolumes;
+
+            bool inRange(float t, vec2 range)
+            {
+                return range.x <= t && t <= range.y;
+            }
+
+            void main()
+            {
+                // Instances only cover the inner voxels of the volume
+                ivec3 inner = textureSize(temperature, 0) - 2;
+                int id = gl_InstanceID;
+                ivec3 cell = ivec3(id % inner.x, (id / inner.x) % inner.y, id / (inner.x*inner.y)) + 1;
+                float t = texelFetch(temperature, cell, 0).r;
+
+                if (showVolumes.x != 0 && inRange(t, rangeA))
+                    fragOriginalColor = colorA;
+                else if (showVolumes.y != 0 && inRange(t, rangeB))
+                    fragOriginalColor = colorB;
+                else if (showVolumes.z != 0 && inRange(t, rangeC))
+                    fragOriginalColor = colorC;
+                else
+                {
+                    // Every vertex outside the clip volume discards the voxel
+                    gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+                    return;
+                }
+
+                vec3 voxelPosition = voxelSize*(vec3(cell) + position);
+                fragPosition = vec3(model * vec4(voxelPosition, 1.0));
+                fragNormal = mat3(transpose(inverse(model))) * normal;
+
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = PHONG_FRAGMENT_SHADER
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, texture, space_shape, mode=GL_TRIANGLES):
+        # shape - GPUShape of createNormalsCube
+        # texture - Temperature 3D texture of a VolumeTexture
+        # space_shape - (nx,ny,nz) dimensions of the temperature volume
+        assert isinstance(shape, GPUShape)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_3D, texture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "temperature"), 0)
+
+        # 3d vertices + 3d normals => 3*4 + 3*4 = 24 bytes
+        position = glGetAttribLocation(self.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        normal = glGetAttribLocation(self.shaderProgram, "normal")
+        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(normal)
+
+        # One instance per inner voxel
+        instances = int(np.prod(np.array(space_shape) - 2))
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, instances)
+
+
+class RayMarchingShaderProgram:
+    # Volume rendering of a temperature 3D texture.
+    # The bounding box of the volume is drawn and each fragment marches a ray
+    # through the field, mapping temperatures with a transfer function.
+    # Rays stop once they are almost opaque and jump over bricks whose
+    # min/max range is outside the visible temperatures.
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+
+            out vec3 fragPosition;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+
+            void main()
+            {
+                fragPosition = vec3(model * vec4(position, 1.0));
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = """
+            #version 330 core
+
+            in vec3 fragPosition;
+
+            out vec4 fragColor;
+
+            uniform vec3 viewPosition;
+            // World position of the sample (0,0,0) and distance between samples
+            uniform vec3 volumeOrigin;
+            uniform float voxelSize;
+
+            uniform sampler3D temperature;
+            uniform sampler3D bricks;
+            uniform sampler1D transferFunction;
+
+            // Temperatures mapped to the ends of the transfer function
+            uniform vec2 temperatureRange;
+            // Temperatures with non zero opacity
+            uniform vec2 visibleRange;
+            uniform float brickSize;
+            // Ray step and opacity per voxel travelled
+            uniform float stepSize;
+            uniform float opacity;
+
+            const float maxAlpha = 0.95;
+            const int maxSteps = 2048;
+
+            vec2 intersectBox(vec3 origin, vec3 invDir, vec3 boxMin, vec3 boxMax)
+            {
+                vec3 t0 = (boxMin - origin) * invDir;
+                vec3 t1 = (boxMax - origin) * invDir;
+                vec3 tMin = min(t0, t1);
+                vec3 tMax = max(t0, t1);
+                return vec2(max(max(tMin.x, tMin.y), tMin.z), min(min(tMax.x, tMax.y), tMax.z));
+            }
+
+            void main()
+            {
+                // March in voxel units
+                vec3 size = vec3(textureSize(temperature, 0));
+                ivec3 brickCount = textureSize(bricks, 0);
+                vec3 origin = (viewPosition - volumeOrigin) / voxelSize;
+                vec3 dir = normalize(fragPosition - viewPosition);
+                vec3 invDir = 1.0 / (dir + vec3(equal(dir, vec3(0.0))) * 1e-6);
+
+                vec2 tBox = intersectBox(origin, invDir, vec3(0.0), size - 1.0);
+                float t = max(tBox.x, 0.0);
+                vec4 result = vec4(0.0);
+
+                for (int i = 0; i < maxSteps && t < tBox.y && result.a < maxAlpha; i++)
+                {
+                    vec3 p = origin + t * dir;
+
+                    // Empty space skipping
+                    vec3 brick = clamp(floor(p / brickSize), vec3(0.0), vec3(brickCount - 1));
+                    vec2 brickRange = texelFetch(bricks, ivec3(brick), 0).rg;
+                    if (brickRange.y < visibleRange.x || brickRange.x > visibleRange.y)
+                    {
+                        vec2 tBrick = intersectBox(origin, invDir, brick * brickSize, (brick + 1.0) * brickSize);
+                        t = max(tBrick.y, t) + 0.01;
+                        continue;
+                    }
+
+                    float value = texture(temperature, (p + 0.5) / size).r;
+                    if (visibleRange.x <= value && value <= visibleRange.y)
+                    {
+                        float u = (value - temperatureRange.x) / (temperatureRange.y - temperatureRange.x);
+                        vec4 color = texture(transferFunction, u);
+                        // Opacity correction for the step length
+                        float alpha = 1.0 - pow(1.0 - clamp(color.a * opacity, 0.0, 1.0), stepSize);
+                        result.rgb += (1.0 - result.a) * alpha * color.rgb;
+                        result.a += (1.0 - result.a) * alpha;
+                    }
+                    t += stepSize;
+                }
+
+                fragColor = result;
+            }
+            """
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, texture, brickTexture, transferTexture, mode=GL_TRIANGLES):
+        # shape - GPUShape of createNormalsCube, scaled by the model to the volume box
+        # texture - Temperature 3D texture of a VolumeTexture with linear filtering
+        # brickTexture - Brick min/max 3D texture from toGPUBrickTexture
+        # transferTexture - Transfer function 1D texture
+        assert isinstance(shape, GPUShape)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_3D, texture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "temperature"), 0)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_3D, brickTexture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "bricks"), 1)
+        glActiveTexture(GL_TEXTURE2)
+        glBindTexture(GL_TEXTURE_1D, transferTexture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "transferFunction"), 2)
+        glActiveTexture(GL_TEXTURE0)
+
+        # 3d vertices + 3d normals => 3*4 + 3*4 = 24 bytes, normals are not used
+        position = glGetAttribLocation(self.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        # Only back faces are rasterized, so rays also start inside the volume
+        glEnable(GL_CULL_FACE)
+        glCullFace(GL_FRONT)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_ONE, GL_ONE_MINUS_SRC_ALPHA)
+        glDepthMask(GL_FALSE)
+
+        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
+
+        glDepthMask(GL_TRUE)
+        glDisable(GL_BLEND)
+        glDisable(GL_CULL_FACE)
+
+
+class FishSchoolShaderProgram:
+    # Draws every fish of a species in one instanced call per body part.
+    # Each instance has a position, a heading and the frequency and phase of
+    # its fin, the fin swing is computed here from the time uniform.
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+            layout (location = 1) in vec3 color;
+            // Per fish attributes
+            layout (location = 2) in vec3 fishPosition;
+            // heading, fin rotation frequency and fin phase
+            layout (location = 3) in vec3 fishMotion;
+
+            out vec3 newColor;
+
+            uniform mat4 projection;
+            uniform mat4 view;
+            uniform mat4 model;
+
+            uniform float time;
+            // Fin position in the body and whether the fin is drawn
+            uniform vec3 finOffset;
+            uniform int isFin;
+
+            mat3 rotationZ(float theta)
+            {
+                float c = cos(theta);
+                float s = sin(theta);
+                return mat3(c, s, 0.0, -s, c, 0.0, 0.0, 0.0, 1.0);
+            }
+
+            void main()
+            {
+                vec3 p = position;
+                if (isFin != 0)
+                    p = finOffset + rotationZ(cos(fishMotion.y * time + fishMotion.z)) * p;
+                p = fishPosition + rotationZ(fishMotion.x) * p;
+
+                gl_Position = projection * view * model * vec4(p, 1.0f);
+                newColor = color;
+            }
+            """
+
+        fragment_shader = """
+            #version 330 core
+            in vec3 newColor;
+
+            out vec4 outColor;
+            void main()
+            {
+                outColor = vec4(newColor, 1.0f);
+            }
+            """
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, instanceVBO, instances, mode=GL_TRIANGLES):
+        # shape - GPUShape with 3d positions and rgb colors
+        # instanceVBO - Buffer with 6 floats per fish: position, heading,
+        #               fin frequency and fin phase
+        # instances - Number of fish to draw
+        assert isinstance(shape, GPUShape)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        # 3d vertices + rgb color specification => 3*4 + 3*4 = 24 bytes
+        position = glGetAttribLocation(self.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        color = glGetAttribLocation(self.shaderProgram, "color")
+        glVertexAttribPointer(color, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(color)
+
+        # 3d position + 3 motion floats => 3*4 + 3*4 = 24 bytes per fish
+        glBindBuffer(GL_ARRAY_BUFFER, instanceVBO)
+        fishPosition = glGetAttribLocation(self.shaderProgram, "fishPosition")
+        glVertexAttribPointer(fishPosition, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(fishPosition)
+        glVertexAttribDivisor(fishPosition, 1)
+
+        fishMotion = glGetAttribLocation(self.shaderProgram, "fishMotion")
+        glVertexAttribPointer(fishMotion, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(fishMotion)
+        glVertexAttribDivisor(fishMotion, 1)
+
+        # Render the active element buffer with the active shader program
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, instances)
+
+
+class InstancedVoxelShaderProgram:
+    # Draws a set of cubes of one color in a single instanced call,
+    # each instance has its own center and side size
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            layout (location = 0) in vec3 position;
+            layout (location = 1) in vec3 normal;
+            // Per voxel center and side size
+            layout (location = 2) in vec4 voxel;
+
+            out vec3 fragPosition;
+            out vec3 fragOriginalColor;
+            out vec3 fragNormal;
+
+            uniform mat4 model;
+            uniform mat4 view;
+            uniform mat4 projection;
+            uniform vec3 color;
+
+            void main()
+            {
+                fragPosition = vec3(model * vec4(voxel.xyz + voxel.w * position, 1.0));
+                fragOriginalColor = color;
+                fragNormal = mat3(transpose(inverse(model))) * normal;
+
+                gl_Position = projection * view * vec4(fragPosition, 1.0);
+            }
+            """
+
+        fragment_shader = PHONG_FRAGMENT_SHADER
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, instanceVBO, instances, mode=GL_TRIANGLES):
+        # shape - GPUShape of createNormalsCube
+        # instanceVBO - Buffer with 4 floats per voxel: center and side size
+        # instances - Number of voxels to draw
+        assert isinstance(shape, GPUShape)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        # 3d vertices + 3d normals => 3*4 + 3*4 = 24 bytes
+        position = glGetAttribLocation(self.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        normal = glGetAttribLocation(self.shaderProgram, "normal")
+        glVertexAttribPointer(normal, 3, GL_FLOAT, GL_FALSE, 24, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(normal)
+
+        # 3d center + side size => 4*4 = 16 bytes per voxel
+        glBindBuffer(GL_ARRAY_BUFFER, instanceVBO)
+        voxel = glGetAttribLocation(self.shaderProgram, "voxel")
+        glVertexAttribPointer(voxel, 4, GL_FLOAT, GL_FALSE, 16, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(voxel)
+        glVertexAttribDivisor(voxel, 1)
+
+        # Render the active element buffer with the active shader program
+        glDrawElementsInstanced(mode, shape.size, GL_UNSIGNED_INT, None, instances)
+
+
+class SliceShaderProgram:
+    # Draws a slice texture of the temperature field mapped through
+    # a transfer function
+
+    def __init__(self):
+        vertex_shader = """
+            #version 330 core
+
+            uniform mat4 projection;
+            uniform mat4 view;
+            uniform mat4 model;
+
+            in vec3 position;
+            in vec2 texCoords;
+
+            out vec2 outTexCoords;
+
+            void main()
+            {
+                gl_Position = projection * view * model * vec4(position, 1.0f);
+                outTexCoords = texCoords;
+            }
+            """
+
+        fragment_shader = """
+            #version 330 core
+
+            uniform sampler2D slice;
+            uniform sampler1D transferFunction;
+            uniform vec2 temperatureRange;
+
+            in vec2 outTexCoords;
+
+            out vec4 outColor;
+
+            void main()
+            {
+                // The quad corners are the centers of the border texels
+                vec2 size = vec2(textureSize(slice, 0));
+                vec2 texCoords = (outTexCoords * (size - 1.0) + 0.5) / size;
+                float value = texture(slice, texCoords).r;
+                float u = (value - temperatureRange.x) / (temperatureRange.y - temperatureRange.x);
+                outColor = vec4(texture(transferFunction, u).rgb, 1.0f);
+            }
+            """
+
+        self.shaderProgram = OpenGL.GL.shaders.compileProgram(
+            OpenGL.GL.shaders.compileShader(vertex_shader, OpenGL.GL.GL_VERTEX_SHADER),
+            OpenGL.GL.shaders.compileShader(fragment_shader, OpenGL.GL.GL_FRAGMENT_SHADER))
+
+
+    def drawShape(self, shape, sliceTexture, transferTexture, mode=GL_TRIANGLES):
+        # shape - GPUShape of createSliceQuad
+        # sliceTexture - Texture of a SliceStream
+        # transferTexture - Transfer function 1D texture
+        assert isinstance(shape, GPUShape)
+
+        # Binding the proper buffers
+        glBindVertexArray(shape.vao)
+        glBindBuffer(GL_ARRAY_BUFFER, shape.vbo)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, shape.ebo)
+
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, sliceTexture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "slice"), 0)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_1D, transferTexture)
+        glUniform1i(glGetUniformLocation(self.shaderProgram, "transferFunction"), 1)
+        glActiveTexture(GL_TEXTURE0)
+
+        # 3d vertices + 2d texture coordinates => 3*4 + 2*4 = 20 bytes
+        position = glGetAttribLocation(self.shaderProgram, "position")
+        glVertexAttribPointer(position, 3, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(0))
+        glEnableVertexAttribArray(position)
+
+        texCoords = glGetAttribLocation(self.shaderProgram, "texCoords")
+        glVertexAttribPointer(texCoords, 2, GL_FLOAT, GL_FALSE, 20, ctypes.c_void_p(12))
+        glEnableVertexAttribArray(texCoords)
+
+        # Render the active element buffer with the active shader program
+        glDrawElements(mode, shape.size, GL_UNSIGNED_INT, None)
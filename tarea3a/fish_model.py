@@ -1,3 +1,5 @@
+from OpenGL.GL import *
+
 import basic_shapes as bs
 import scene_graph as sg
 import transformations as tr
@@ -80,3 +82,45 @@ class Fish(object):
         # time - Current time
         theta = np.cos(self.rotFrec*time + self.phase)
         self.fin_rot.transform = tr.rotationZ(theta)
+
+# Class to manage all the fish of a species with instanced rendering
+class FishSchool(object):
+    def __init__(self, gpuBody, gpuFin, finBodyTR, positions, headings, rotFrec):
+        # gpuBody - Fish body gpu object
+        # gpuFin  - Fish fin gpu object
+        # finBodyTR - Transform between body and fin
+        # positions - (N,3) array of fish positions
+        # headings - (N,) array of fish rotation around the z axis
+        # rotFrec - Frecuency of the fin movement
+        self.gpuBody = gpuBody
+        self.gpuFin = gpuFin
+        self.finOffset = np.array(finBodyTR)[:3,3]
+        self.size = len(positions)
+        # Per fish attributes: position, heading, fin frecuency and fin phase
+        self.instances = np.zeros((self.size, 6), dtype=np.float32)
+        self.instances[:,4] = rotFrec
+        self.instances[:,5] = 2*np.pi*np.random.random(self.size)
+        self.vbo = glGenBuffers(1)
+        self.set_positions(positions, headings)
+
+    def set_positions(self, positions, headings):
+        # Method to move the fish, uploads the instance buffer
+        # positions - (N,3) array of fish positions
+        # headings - (N,) array of fish rotation around the z axis
+        self.instances[:,:3] = positions
+        self.instances[:,3] = headings
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.instances.nbytes, self.instances, GL_DYNAMIC_DRAW)
+
+    def draw(self, pipeline, time):
+        # Method to draw the school, the fin swing is computed in the shader
+        # pipeline - FishSchoolShaderProgram in use
+        # time - Current time
+        if self.size == 0:
+            return
+        glUniform1f(glGetUniformLocation(pipeline.shaderProgram, "time"), time)
+        glUniform3f(glGetUniformLocation(pipeline.shaderProgram, "finOffset"), *self.finOffset)
+        glUniform1i(glGetUniformLocation(pipeline.shaderProgram, "isFin"), 0)
+        pipeline.drawShape(self.gpuBody, self.vbo, self.size)
+        glUniform1i(glGetUniformLocation(pipeline.shaderProgram, "isFin"), 1)
+        pipeline.drawShape(self.gpuFin, self.vbo, self.size)
@@ -0,0 +1,157 @@
+import numpy as np
+
+# A class to simulate a school of fish swimming inside its preferred volume
+class SchoolSimulation(object):
+    def __init__(self, positions, inside, h, radius=0.2, separation=0.08,
+                 min_speed=0.1, max_speed=0.3, max_pairs=4):
+        # positions - (N,3) array of fish positions, all inside the volume
+        # inside - (nx,ny,nz) boolean volume, True where the fish like the temperature
+        # h - Distance between volume cells
+        # radius - Distance at which fish see their neighbors
+        # separation - Distance that fish keep between them
+        # min_speed, max_speed - Speed limits of the fish
+        # max_pairs - Fish checked ahead in the grid order for separation
+        self.positions = np.array(positions, dtype=np.float64)
+        self.size = len(self.positions)
+        self.inside = inside
+        self.h = h
+        self.radius = radius
+        self.separation = separation
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.max_pairs = max_pairs
+        # Swimming is mostly horizontal
+        directions = np.random.normal(size=(self.size, 3))*[1.0, 1.0, 0.2]
+        directions /= np.maximum(np.linalg.norm(directions, axis=1), 1e-9)[:, np.newaxis]
+        self.velocities = directions*min_speed
+        # Last position of each fish inside the volume, used to come back
+        self.anchors = self.positions.copy()
+        # Fish are stored sorted by grid cell, ids maps them to their original order
+        self.ids = np.arange(self.size)
+        # Uniform grid over the volume with cells of the neighbor radius
+        self.upper = (np.array(inside.shape) - 1)*h
+        self.grid_shape = tuple(np.maximum(np.ceil(self.upper/radius).astype(int), 1))
+        # Finer grid used to sort the fish for the separation rule
+        self.fine_shape = tuple(np.maximum(np.ceil(self.upper/separation).astype(int), 1))
+
+    def _grid_keys(self, cell_size, grid_shape):
+        # Method to find the grid cell of every fish
+        # cell_size - Side of the grid cells
+        # grid_shape - Number of cells along each axis
+        # return - (N,) flat cell index of each fish
+        cells = (self.positions/cell_size).astype(int)
+        cells = np.clip(cells, 0, np.array(grid_shape) - 1)
+        return np.ravel_multi_index(cells.T, grid_shape)
+
+    def _neighbor_sums(self, keys):
+        # Method to add fish quantities over the 27 cells around every fish
+        # Sums are built per grid cell with bincount and then added over the
+        # 27 neighbor cells, so the cost does not depend on the fish density
+        # keys - (N,) flat grid cell of each fish
+        # return - (N,) fish count, (N,3) position sum, (N,3) velocity sum
+        n_cells = int(np.prod(self.grid_shape))
+        weights = [None] + [self.positions[:, a] for a in range(3)] + [self.velocities[:, a] for a in range(3)]
+        grid = np.stack([np.bincount(keys, weights=w, minlength=n_cells) for w in weights], axis=-1)
+        grid = grid.reshape(self.grid_shape + (7,))
+        # The 3x3x3 box sum is separable, one pass per axis
+        for axis in range(3):
+            total = grid.copy()
+            front = [slice(None)]*4
+            back = [slice(None)]*4
+            front[axis] = slice(1, None)
+            back[axis] = slice(None, -1)
+            total[tuple(back)] += grid[tuple(front)]
+            total[tuple(front)] += grid[tuple(back)]
+            grid = total
+        total = grid.reshape(n_cells, 7)[keys]
+        return total[:, 0], total[:, 1:4], total[:, 4:7]
+
+    def _separation(self, keys):
+        # Method to push apart fish that are too close
+        # Fish are kept sorted by a grid of the separation size and each one is
+        # compared with the next max_pairs fish of its cell, which bounds the
+        # work per fish
+        # keys - (N,) sorted flat separation grid cell of each fish
+        # return - (N,3) array of separation forces
+        push = np.zeros_like(self.positions)
+        limit = self.separation**2
+        for s in range(1, min(self.max_pairs, self.size - 1) + 1):
+            diff = self.positions[:-s] - self.positions[s:]
+            distance2 = np.einsum('ij,ij->i', diff, diff)
+            close = (keys[:-s] == keys[s:]) & (distance2 < limit)
+            force = diff*(close/np.maximum(distance2, 1e-12))[:, np.newaxis]
+            push[:-s] += force
+            push[s:] -= force
+        return push
+
+    def _is_inside(self, positions):
+        # Method to check positions against the preferred volume
+        # positions - (N,3) array of positions
+        # return - (N,) boolean array
+        cells = np.rint(positions/self.h).astype(int)
+        cells = np.clip(cells, 0, np.array(self.inside.shape) - 1)
+        return self.inside[cells[:, 0], cells[:, 1], cells[:, 2]]
+
+    def _sort(self, keys):
+        # Method to keep the fish ordered by grid cell
+        # The order changes little between steps, so sorting is cheap
+        # keys - (N,) flat separation grid cell of each fish
+        # return - Sorted keys
+        order = np.argsort(keys, kind='stable')
+        self.ids = self.ids[order]
+        self.positions = self.positions[order]
+        self.velocities = self.velocities[order]
+        self.anchors = self.anchors[order]
+        return keys[order]
+
+    def step(self, dt, cohesion=0.5, alignment=1.0, avoidance=0.002, homing=2.0, damping=6.0):
+        # Method to move the fish
+        # dt - Time step
+        # cohesion, alignment, avoidance, homing - Weights of the steering rules
+        # damping - Decay rate of the vertical speed, per second. The default
+        #           keeps about 0.9 of the vertical speed every 1/60 s
+        if self.size == 0:
+            return
+        fine_keys = self._sort(self._grid_keys(self.separation, self.fine_shape))
+        keys = self._grid_keys(self.radius, self.grid_shape)
+        count, position_sum, velocity_sum = self._neighbor_sums(keys)
+        # Every fish is counted in its own neighborhood
+        others = (1.0/np.maximum(count - 1, 1))[:, np.newaxis]
+        center = (position_sum - self.positions)*others
+        mean_velocity = (velocity_sum - self.velocities)*others
+        steer = cohesion*(center - self.positions) + alignment*(mean_velocity - self.velocities)
+        steer *= (count > 1)[:, np.newaxis]
+        steer += avoidance*self._separation(fine_keys)
+
+        # Fish outside their volume swim back to where they left it
+        # The anchor of a fish inside is its own position, so it is not pulled
+        inside = self._is_inside(self.positions)
+        np.copyto(self.anchors, self.positions, where=inside[:, np.newaxis])
+        steer += homing*(self.anchors - self.positions)
+
+        velocities = self.velocities + dt*steer
+        velocities[:, 2] *= np.exp(-damping*dt)
+        speed = np.sqrt(np.einsum('ij,ij->i', velocities, velocities))
+        limited = np.clip(speed, self.min_speed, self.max_speed)
+        velocities *= (limited/np.maximum(speed, 1e-9))[:, np.newaxis]
+
+        # Tank walls
+        positions = self.positions + dt*velocities
+        walls = (positions < 0) | (positions > self.upper)
+        self.velocities = np.where(walls, -velocities, velocities)
+        self.positions = np.clip(positions, 0, self.upper)
+
+    def fish_positions(self):
+        # Method to get the fish positions in their original order
+        # return - (N,3) array of positions
+        positions = np.empty_like(self.positions)
+        positions[self.ids] = self.positions
+        return positions
+
+    def headings(self):
+        # Method to get the fish rotation around the z axis
+        # The fish models point to -x
+        # return - (N,) array of angles in the original fish order
+        headings = np.empty(self.size)
+        headings[self.ids] = np.arctan2(-self.velocities[:, 1], -self.velocities[:, 0])
+        return headings
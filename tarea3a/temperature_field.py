@@ -0,0 +1,75 @@
+import numpy as np
+
+def _brick_reduce(a, axis, brick_size, ufunc):
+    # Function to reduce an array over bricks along one axis
+    # Consecutive bricks share their border sample
+    # a - Array to reduce
+    # axis - Axis to reduce
+    # brick_size - Number of cells of each brick
+    # ufunc - Reduction function (np.minimum or np.maximum)
+    # return - Reduced array with one entry per brick along axis
+    n = a.shape[axis]
+    n_bricks = max(1, int(np.ceil((n-1)/brick_size)))
+    # Repeat the last sample so every brick is complete
+    pad = [(0,0)]*a.ndim
+    pad[axis] = (0, n_bricks*brick_size + 1 - n)
+    a = np.moveaxis(np.pad(a, pad, mode='edge'), axis, 0)
+    body = a[:n_bricks*brick_size].reshape((n_bricks, brick_size) + a.shape[1:])
+    reduced = ufunc(ufunc.reduce(body, axis=1), a[brick_size::brick_size])
+    return np.moveaxis(reduced, 0, axis)
+
+def brick_min_max(space, brick_size=8):
+    # Function to build a coarse min/max table of a volume
+    # Brick (a,b,c) covers the samples [a*brick_size, (a+1)*brick_size]
+    # along each axis, borders included, so it also bounds any value
+    # interpolated inside the brick
+    # space - (nx,ny,nz) scalar volume
+    # brick_size - Number of cells of each brick side
+    # return - (bx,by,bz,2) array with the min and max of each brick
+    low = space
+    high = space
+    for axis in range(3):
+        low = _brick_reduce(low, axis, brick_size, np.minimum)
+        high = _brick_reduce(high, axis, brick_size, np.maximum)
+    return np.stack([low, high], axis=-1).astype(np.float32)
+
+# A class to answer temperature range queries over a solved volume
+class TemperatureIndex(object):
+    def __init__(self, space, brick_size=8):
+        # Index is built once, border cells are left out as in the viewer
+        # space - (nx,ny,nz) temperature volume
+        # brick_size - Number of cells of each brick side
+        self.shape = space.shape
+        inner = np.zeros(space.shape, dtype=bool)
+        inner[1:-1, 1:-1, 1:-1] = True
+        cells = np.flatnonzero(inner)
+        values = space.ravel()[cells]
+        # Cell indices sorted by temperature
+        order = np.argsort(values, kind='stable')
+        self.cells = cells[order]
+        self.values = values[order]
+        self.brick_size = brick_size
+        self.bricks = brick_min_max(space, brick_size)
+
+    def query(self, t_min, t_max):
+        # Method to find the cells with temperature in [t_min, t_max]
+        # t_min, t_max - Temperature range
+        # return - Array of flat cell indices (a view of the index)
+        start = np.searchsorted(self.values, t_min, side='left')
+        end = np.searchsorted(self.values, t_max, side='right')
+        return self.cells[start:end]
+
+    def sample(self, t_min, t_max, n):
+        # Method to pick random cells with temperature in [t_min, t_max]
+        # t_min, t_max - Temperature range
+        # n - Number of cells to pick
+        # return - Array of n flat cell indices
+        cells = self.query(t_min, t_max)
+        return cells[np.random.choice(len(cells), n, replace=False)]
+
+    def positions(self, cells, h):
+        # Method to get the position of cells
+        # cells - Array of flat cell indices
+        # h - Distance between cells
+        # return - (N,3) array of positions
+        return np.column_stack(np.unravel_index(cells, self.shape))*h
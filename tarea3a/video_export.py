@@ -0,0 +1,158 @@
+# coding=utf-8
+"""
+Offscreen rendering and frame export
+"""
+
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from OpenGL.GL import *
+import numpy as np
+from PIL import Image
+
+
+# A class to render into an offscreen framebuffer
+class Framebuffer(object):
+    def __init__(self, width, height):
+        # width, height - Size of the framebuffer in pixels
+        self.width = width
+        self.height = height
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+
+        # Color and depth are stored in renderbuffers
+        self.color = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.color)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.color)
+
+        self.depth = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth)
+
+        assert glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def bind(self):
+        # Method to draw into the framebuffer
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, self.width, self.height)
+
+
+# A class to read frames back without waiting for the GPU
+class FrameReader(object):
+    def __init__(self, width, height):
+        # width, height - Size of the frames in pixels
+        self.width = width
+        self.height = height
+        self.nbytes = width*height*4
+        # Frame n is copied into one buffer while frame n-1 is mapped from the other
+        self.pbos = glGenBuffers(2)
+        for pbo in self.pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.nbytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.next_pbo = 0
+        self.pending = False
+
+    def read(self):
+        # Method to start reading the bound framebuffer
+        # return - Previous frame as a (height,width,4) uint8 array, None for the first frame
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[self.next_pbo])
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        self.next_pbo = 1 - self.next_pbo
+        frame = self._map(self.pbos[self.next_pbo]) if self.pending else None
+        self.pending = True
+        return frame
+
+    def flush(self):
+        # Method to get the last frame started by read
+        # return - Last frame as a (height,width,4) uint8 array, None if there is none
+        if not self.pending:
+            return None
+        self.pending = False
+        return self._map(self.pbos[1 - self.next_pbo])
+
+    def _map(self, pbo):
+        # Method to copy a pixel buffer into memory
+        # pbo - Pixel buffer to copy
+        # return - (height,width,4) uint8 array, top row first
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        data = glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, self.nbytes)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        frame = np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 4)
+        # OpenGL rows start at the bottom of the image
+        return frame[::-1]
+
+
+# A class to send raw frames to an encoder process from a writer thread
+class EncoderWriter(object):
+    def __init__(self, filename, width, height, fps, max_pending=8):
+        # filename - Video file to write
+        # width, height - Size of the frames in pixels
+        # fps - Frames per second of the video
+        # max_pending - Number of frames waiting for the encoder before write blocks
+        self.process = subprocess.Popen([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(fps),
+            "-i", "-", "-pix_fmt", "yuv420p", filename],
+            stdin=subprocess.PIPE)
+        # A single thread keeps the frames in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+        self.max_pending = max_pending
+
+    def _send(self, data):
+        # Method to write a frame to the encoder, runs in the writer thread
+        self.process.stdin.write(data)
+
+    def write(self, frame):
+        # frame - (height,width,4) uint8 array
+        data = np.ascontiguousarray(frame).tobytes()
+        self.futures.append(self.executor.submit(self._send, data))
+        # Limit the frames waiting in memory
+        while len(self.futures) > self.max_pending:
+            self.futures.pop(0).result()
+
+    def close(self):
+        # Method to wait for the frames still being written and finish the video
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# A class to write frames as a PNG sequence from a pool of threads
+class PNGWriter(object):
+    def __init__(self, directory, workers=4):
+        # directory - Directory where frames are written
+        # workers - Number of writer threads
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+        self.workers = workers
+        self.count = 0
+
+    def _save(self, frame, filename):
+        # Method to write a frame, runs in the writer threads
+        Image.fromarray(frame, "RGBA").save(filename)
+
+    def write(self, frame):
+        # frame - (height,width,4) uint8 array
+        filename = os.path.join(self.directory, f"frame_{self.count:05d}.png")
+        self.count += 1
+        self.futures.append(self.executor.submit(self._save, np.copy(frame), filename))
+        # Limit the frames waiting in memory
+        while len(self.futures) > 4*self.workers:
+            self.futures.pop(0).result()
+
+    def close(self):
+        # Method to wait for the frames still being written
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
@@ -0,0 +1,65 @@
+import numpy as np
+
+def _reduce_occupancy(occupancy):
+    # Function to build the next level of an occupancy pyramid
+    # A coarse cell is occupied if any of its 8 children is
+    # occupancy - (nx,ny,nz) boolean volume
+    # return - (ceil(nx/2),ceil(ny/2),ceil(nz/2)) boolean volume
+    pad = [(0, n % 2) for n in occupancy.shape]
+    occupancy = np.pad(occupancy, pad, mode='constant')
+    nx, ny, nz = occupancy.shape
+    blocks = occupancy.reshape(nx//2, 2, ny//2, 2, nz//2, 2)
+    return blocks.any(axis=(1, 3, 5))
+
+# Offsets of the 8 children of a pyramid node
+_CHILD_OFFSETS = np.array(
+    [[i, j, k] for i in range(2) for j in range(2) for k in range(2)])
+
+# A class to select voxels of an occupancy volume at several levels of detail
+class OccupancyPyramid(object):
+    def __init__(self, occupancy, voxel_size):
+        # occupancy - (nx,ny,nz) boolean volume, cell (i,j,k) is centered at (i,j,k)*voxel_size
+        # voxel_size - Side size of the voxels
+        self.voxel_size = voxel_size
+        # Level 0 is the full resolution volume, each level halves the resolution
+        self.levels = [np.asarray(occupancy, dtype=bool)]
+        while max(self.levels[-1].shape) > 1:
+            self.levels.append(_reduce_occupancy(self.levels[-1]))
+
+    def node_centers(self, nodes, level):
+        # Method to get the center of pyramid nodes
+        # nodes - (N,3) integer array of node coordinates
+        # level - Level of the nodes
+        # return - (N,3) array of positions
+        return ((nodes + 0.5)*2**level - 0.5)*self.voxel_size
+
+    def select(self, view_pos, pixel_scale, max_pixels=4.0):
+        # Method to choose the level of each region from its projected size
+        # Nodes are refined from the coarsest level while they cover more
+        # than max_pixels on screen, so the number of selected voxels is
+        # bounded by the screen resolution
+        # view_pos - Camera position in the volume coordinates
+        # pixel_scale - Screen height / (2*tan(fovy/2))
+        # max_pixels - Largest projected size of a selected voxel
+        # return - List of (positions (N,3), size) pairs, one per level
+        selected = []
+        top = len(self.levels) - 1
+        nodes = np.argwhere(self.levels[top])
+        for level in range(top, -1, -1):
+            size = self.voxel_size*2**level
+            centers = self.node_centers(nodes, level)
+            if level == 0:
+                selected.append((centers, size))
+                break
+            distance = np.linalg.norm(centers - view_pos, axis=1)
+            projected = size*pixel_scale/np.maximum(distance, 1e-6)
+            refine = projected > max_pixels
+            selected.append((centers[~refine], size))
+            # Children of the refined nodes that hold occupied cells
+            children = (2*nodes[refine])[:, np.newaxis, :] + _CHILD_OFFSETS
+            children = children.reshape(-1, 3)
+            finer = self.levels[level-1]
+            inside = np.all(children < finer.shape, axis=1)
+            children = children[inside]
+            nodes = children[finer[children[:,0], children[:,1], children[:,2]]]
+        return [(centers, size) for centers, size in selected if len(centers) > 0]